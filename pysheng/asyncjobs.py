@@ -33,16 +33,41 @@ http://code.activestate.com/recipes/577129-run-asynchronous-tasks-using-coroutin
 
 import time
 from threading import Thread, Event
-from Queue import Queue, Empty
+from Queue import Queue, Empty, Full
 from io import BytesIO
-import urllib2
 import functools
 
-import gobject
-gobject.threads_init()
+import lib
+import metrics
+import throttle
+
+
+class _LazyGobject(object):
+    """
+    Import gobject and initialize its threads support on first use, so
+    importing this module does not load (or require) the GUI libraries.
+    The module global is then replaced by the real gobject module.
+
+    This is only for non-GUI callers: the first use may happen after the
+    main loop has started, so the GUI initializes threads on its own.
+    """
+    def __getattr__(self, name):
+        import gobject as gobject_module
+        gobject_module.threads_init()
+        globals()["gobject"] = gobject_module
+        return getattr(gobject_module, name)
+
+
+gobject = _LazyGobject()
 
 JobCancelled = GeneratorExit
 
+# Seconds between checks of the timeouts of a task (see Task.set_timeouts)
+WATCHDOG_INTERVAL = 0.25
+
+# Immediate tasks consumed in a row before returning to the main loop
+MAX_IMMEDIATE_STEPS = 100
+
 
 class TaskError(Exception):
     """Something wrong was detected inside a task and it must be aborted."""
@@ -59,11 +84,17 @@ class Job:
     yield asynchronous tasks.
 
     States: running (default on start), cancel, paused, cancelled, finished.
+
+    A job run by a Scheduler waits for a free slot before running a task
+    that uses one (see Task.uses_slot).
     """
 
-    def __init__(self, generator):
+    def __init__(self, generator, scheduler=None):
         self.generator = generator
+        self.scheduler = scheduler
+        self.has_slot = False
         self._paused_task = None
+        self._waiting_task = None
         self.current_task = None
         self._state = "running"
         self._advance_task(None, generator, "send", None)
@@ -83,13 +114,18 @@ class Job:
 
     def pause(self):
         self._check_state("running")
-        self.current_task.pause()
+        if self.current_task and not self._waiting_task:
+            self.current_task.pause()
         self._state = "paused"
 
     def resume(self):
         self._check_state("paused")
-        self.current_task.resume()
+        if self.current_task and not self._waiting_task:
+            self.current_task.resume()
         self._state = "running"
+        if self._waiting_task:
+            # Paused jobs get no slots
+            self.scheduler.dispatch()
         if self._paused_task:
             self._advance_task(*self._paused_task)
             self._paused_task = None
@@ -97,19 +133,88 @@ class Job:
     def cancel(self):
         self._check_state("running", "paused")
         if self.current_task:
-            self.current_task.cancel()
+            if self._waiting_task:
+                self._waiting_task = None
+                self.scheduler.cancel_request(self)
+            else:
+                self.current_task.cancel()
             self.current_task = None
             self.generator.close()
-        self._state = "cancelled"
+        self._finish("cancelled")
+
+    def run_waiting_task(self):
+        """Run the task that waits for a slot (called by the scheduler,
+        which has given a slot to the job)."""
+        task, generator = self._waiting_task
+        self._waiting_task = None
+        self.has_slot = True
+        self._run_task(task, generator)
+
+    def _release_slot(self):
+        if self.has_slot:
+            self.has_slot = False
+            self.scheduler.release_slot(self)
+
+    def _finish(self, state):
+        self._state = state
+        self._release_slot()
+        if self.scheduler:
+            self.scheduler.job_finished(self)
 
     def _start_task(self, task, generator):
         self.current_task = task
+        if self.scheduler and task.uses_slot:
+            self._waiting_task = (task, generator)
+            self.scheduler.request_slot(self)
+        else:
+            self._run_task(task, generator)
+
+    def _run_task(self, task, generator):
         task.config(functools.partial(self._advance_task, task, generator,
                                       "send"),
                     functools.partial(self._advance_task, task, generator,
                                       "throw"))
         task.run()
         self._state = "running"
+        self._watch(task)
+
+    def _watch(self, task):
+        """Check periodically the timeouts of a task, if any."""
+        if not (task.timeout or task.stall_timeout):
+            return
+        watch = dict(last_check=time.time(), running=0.0, stalled=0.0,
+                     progress=task.get_progress())
+        gobject.timeout_add(int(WATCHDOG_INTERVAL * 1000), self._check_task,
+                            task, watch)
+
+    def _check_task(self, task, watch):
+        if task.done or not self.is_alive():
+            return False
+        now = time.time()
+        elapsed, watch["last_check"] = now - watch["last_check"], now
+        if self._state == "paused":
+            # Time spent paused counts neither as running nor as stalled
+            return True
+        progress = task.get_progress()
+        if progress != watch["progress"]:
+            watch["progress"] = progress
+            watch["stalled"] = 0.0
+        else:
+            watch["stalled"] += elapsed
+        watch["running"] += elapsed
+        if task.timeout and watch["running"] > task.timeout:
+            reason = "timed out after %s seconds" % task.timeout
+        elif task.stall_timeout and watch["stalled"] > task.stall_timeout:
+            if task.reconnect():
+                watch["stalled"] = 0.0
+                return True
+            reason = "stalled for %s seconds" % task.stall_timeout
+        else:
+            return True
+        task.cancel()
+        task.exception_cb(TaskError("%s %s" % (task.__class__.__name__,
+                                               reason)))
+        return False
 
     def _advance_task(self, task, generator, method, result=None):
         # Instead of advancing the task/coroutine right away, we defer
@@ -117,6 +222,7 @@ class Job:
         # could catches exceptions in the coroutine
         if task != self.current_task:
             raise TaskError("only the current task can reply to the coroutine")
+        self._release_slot()
         if self._state == "running":
             gobject.idle_add(self._advance_task_cb, generator, method, result)
         elif self._state == "paused":
@@ -124,25 +230,31 @@ class Job:
 
     def _advance_task_cb(self, generator, method, result):
         self.current_task = None
+        immediate_steps = 0
         while 1:
             generator, method, result = \
                 self._advance_task_step(generator, method, result)
             if not generator:
                 return
-            elif method == "new_task":
-                task = result
-                break
+            task = result
+            if (isinstance(task, ImmediateTask) and self._state == "running"
+                    and immediate_steps < MAX_IMMEDIATE_STEPS):
+                # Reply right away, without a round trip to the main loop
+                immediate_steps += 1
+                method, result = task.get_reply()
+                continue
+            break
         self._start_task(task, generator)
 
     def _advance_task_step(self, generator, method, result):
         try:
             new_task = getattr(generator, method)(result)
         except StopIteration, exc:
-            self._state = "finished"
+            self._finish("finished")
             return None, None, None
         except Exception, exc:
             generator.close()
-            self._state = "finished"
+            self._finish("finished")
             raise
         if isinstance(new_task, Task):
             task = new_task
@@ -158,6 +270,144 @@ class Job:
                 (self._state, "/".join(expected))
             raise ValueError(msg)
 
+
+class ScheduledJob:
+    """A job added to a Scheduler (the Job is created when it starts)."""
+    def __init__(self, generator, priority=0, name=None):
+        self.generator = generator
+        self.priority = priority
+        self.name = name
+        self.job = None
+        self.cancelled = False
+        self.last_slot = 0
+
+    def get_state(self):
+        """Return queued, running, paused, cancelled or finished."""
+        if self.job:
+            return self.job._state
+        return ("cancelled" if self.cancelled else "queued")
+
+
+class Scheduler:
+    """
+    Run many jobs: up to max_jobs at the same time (the others are queued,
+    and started by priority, higher first) and, between all of them, up to
+    max_tasks tasks that use a slot (threads and connections, see
+    Task.uses_slot). A free slot is given to the waiting job with the
+    highest priority and, between jobs of the same priority, to the one
+    that has waited longest since its last slot (so they share the slots
+    fairly). The throughput of all the jobs is measured from the metrics
+    events (see metrics.Throughput).
+
+    A task holds its slot until it's done, so max_tasks limits tasks, not
+    the connections they make: a ThreadedGeneratorTask that downloads a
+    whole book takes a single slot. Connections are limited per download
+    by throttle.hosts.
+
+    scheduler = Scheduler(max_jobs=4, max_tasks=8)
+    entry = scheduler.add(download_book(url), priority=1, name=url)
+    """
+    def __init__(self, max_jobs=None, max_tasks=None, window=10.0):
+        self.max_jobs = max_jobs
+        self.max_tasks = max_tasks
+        self.entries = []
+        self.tasks = 0
+        self.paused = False
+        self._waiting = []
+        self._slots = 0
+        self.throughput = metrics.Throughput(window)
+        metrics.add_hook(self.throughput)
+
+    def add(self, generator, priority=0, name=None):
+        """Queue a job (a generator, see Job) and return its ScheduledJob."""
+        entry = ScheduledJob(generator, priority, name)
+        self.entries.append(entry)
+        self._start_jobs()
+        return entry
+
+    def cancel(self, entry):
+        if entry.job:
+            if entry.job.is_alive():
+                entry.job.cancel()
+        else:
+            entry.cancelled = True
+
+    def pause_all(self):
+        """Pause the running jobs and do not start queued ones."""
+        self.paused = True
+        for entry in self.entries:
+            if entry.get_state() == "running":
+                entry.job.pause()
+
+    def resume_all(self):
+        self.paused = False
+        for entry in self.entries:
+            if entry.get_state() == "paused":
+                entry.job.resume()
+        self._start_jobs()
+
+    def set_max_jobs(self, max_jobs):
+        self.max_jobs = max_jobs
+        self._start_jobs()
+
+    def is_alive(self):
+        return any(entry.get_state() in ("queued", "running", "paused")
+                   for entry in self.entries)
+
+    def get_throughput(self):
+        """Return (bytes per second, pages per minute) of all the jobs."""
+        return self.throughput.get_rates()
+
+    def close(self):
+        """Stop measuring the throughput (jobs are not cancelled)."""
+        metrics.remove_hook(self.throughput)
+
+    def request_slot(self, job):
+        self._waiting.append(job)
+        self.dispatch()
+
+    def cancel_request(self, job):
+        if job in self._waiting:
+            self._waiting.remove(job)
+
+    def release_slot(self, job):
+        self.tasks -= 1
+        self.dispatch()
+
+    def job_finished(self, job):
+        self.cancel_request(job)
+        self._start_jobs()
+
+    def dispatch(self):
+        """Give the free slots to the jobs waiting for them."""
+        while self.max_tasks is None or self.tasks < self.max_tasks:
+            candidates = [job for job in self._waiting
+                          if job._state == "running"]
+            if not candidates:
+                break
+            entries = dict((entry.job, entry) for entry in self.entries
+                           if entry.job in candidates)
+            job = min(candidates, key=lambda job: (-entries[job].priority,
+                                                   entries[job].last_slot))
+            self._waiting.remove(job)
+            self._slots += 1
+            entries[job].last_slot = self._slots
+            self.tasks += 1
+            job.run_waiting_task()
+
+    def _start_jobs(self):
+        if self.paused:
+            return
+        while 1:
+            states = [entry.get_state() for entry in self.entries]
+            running = states.count("running") + states.count("paused")
+            queued = [entry for (entry, state) in zip(self.entries, states)
+                      if state == "queued"]
+            if not queued or (self.max_jobs and running >= self.max_jobs):
+                break
+            entry = max(queued, key=lambda entry: entry.priority)
+            entry.job = Job(entry.generator, scheduler=self)
+
 # Tasks
 
 
@@ -204,10 +454,46 @@ class Task:
     Tasks must override methods run and, optionally, cancel, pause and resume.
     In order to get robust tasks, make sure that all asynchronous callbacks
     that may raise an exception use a @propagate_exceptions decorator.
+
+    A task can have timeouts (see set_timeouts): when one of them expires,
+    the job cancels the task and raises TaskError in the coroutine.
     """
+    timeout = None
+    stall_timeout = None
+    done = False
+    # Tasks that run a thread or open connections take a slot of the
+    # scheduler of the job (if any) while they run
+    uses_slot = False
+
     def config(self, return_cb, exception_cb):
-        self.return_cb = return_cb
-        self.exception_cb = exception_cb
+        self.return_cb = functools.partial(self._done, return_cb)
+        self.exception_cb = functools.partial(self._done, exception_cb)
+
+    def set_timeouts(self, timeout=None, stall_timeout=None):
+        """
+        Set the maximum seconds the task may run (timeout) and may run
+        without progress (stall_timeout, see get_progress). Time spent
+        paused does not count. Return the task itself, so it can be used:
+
+        data = yield ProgressDownloadThreadedTask(url).set_timeouts(60, 10)
+        """
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        return self
+
+    def get_progress(self):
+        """Return a value that changes while the task progresses (None if
+        unknown, so the task is stalled unless it finishes)."""
+        return None
+
+    def reconnect(self):
+        """Called when the task is stalled. Return True if the task recovers
+        (it's given stall_timeout seconds more), False to abort it."""
+        return False
+
+    def _done(self, callback, value):
+        self.done = True
+        callback(value)
 
     def run(self):
         raise RuntimeError('Run method must be overriden by children classes')
@@ -251,12 +537,37 @@ class SleepTask(Task):
         self.return_cb(self.elapsed_time)
         return False
 
+
+class ImmediateTask(Task):
+    """
+    Return a value (or raise an exception) right away, i.e. a result that
+    was already available (a cache hit, an existing file). The job replies
+    to the coroutine without a round trip to the main loop, unless it has
+    done it MAX_IMMEDIATE_STEPS times in a row (so a coroutine that yields
+    many of them does not starve the UI).
+    """
+    def __init__(self, value=None, exception=None):
+        self.value = value
+        self.exception = exception
+
+    def get_reply(self):
+        """Return the (method, result) pair for the coroutine."""
+        if self.exception is not None:
+            return "throw", self.exception
+        return "send", self.value
+
+    def run(self):
+        method, result = self.get_reply()
+        if method == "throw":
+            self.exception_cb(result)
+        else:
+            self.return_cb(result)
+
+
 # Some ideas for threaded classes:
 #
 # - ThreadedEventTask: function has cancel and pause event arguments and can
 #                      respond to these events.
-# - ThreadedGeneratorTask: run a generator instead of a normal function and
-#                          call a callback for each yielded value
 
 
 class ThreadedTask(Task):
@@ -264,24 +575,33 @@ class ThreadedTask(Task):
     Run a function in a new thread and return the result.
 
     The function being run knows nothing about threads or events, so there is
-    no way to cancel or pause it. Therefore, the class does not implement these
-    methods either.
+    no way to pause it or stop it. On cancel, downloads made by the function
+    with lib.download are aborted (see lib.abort_downloads) and the result of
+    the function is discarded.
     """
+    uses_slot = True
+
     def __init__(self, fun, *args, **kwargs):
         self.function = (fun, args, kwargs)
+        self.cancelled = False
 
     def run(self):
         queue = Queue()
-        thread = Thread(target=self._thread_manager,
-                        args=(self.function, queue))
-        thread.setDaemon(True)
-        thread.start()
+        self.thread = Thread(target=self._thread_manager,
+                             args=(self.function, queue))
+        self.thread.setDaemon(True)
+        self.thread.start()
         self.source_id = gobject.timeout_add(50, self._thread_receiver, queue)
 
+    def cancel(self):
+        self.cancelled = True
+        gobject.source_remove(self.source_id)
+        lib.abort_downloads(self.thread.ident)
+
     @propagate_exceptions
     def _thread_receiver(self, queue):
         if queue.empty():
-            if not thread.isAlive():
+            if not self.thread.isAlive():
                 self.exception_cb(TaskError('thread is dead but the queue '
                                             'is empty'))
                 return False
@@ -299,20 +619,150 @@ class ThreadedTask(Task):
             result = fun(*args, **kwargs)
         except Exception, exc:
             queue.put(("exception", exc))
-            raise
+            if not self.cancelled:
+                raise
+            return
         queue.put(("return", result))
 
 
+class ThreadedGeneratorTask(Task):
+    """
+    Run a generator in a new thread, pass each value it yields to 'item_cb'
+    (in the main loop) and return the number of values.
+
+    The thread gets at most 'buffer_size' values ahead of the main loop (it
+    waits until they are consumed), so a slow consumer slows down the
+    generator instead of piling up its values. On pause, the thread stops
+    before asking the generator for the next value, and downloads made by
+    the generator with lib.download are interrupted until it's resumed
+    (see lib.pause_downloads). On cancel, those downloads are aborted, the
+    generator is closed in its thread and the values not consumed are
+    discarded. get_downloads returns the downloads in progress.
+
+    npages = yield ThreadedGeneratorTask(download_pages(), item_cb=show)
+    """
+    uses_slot = True
+
+    def __init__(self, generator, item_cb=None, buffer_size=1):
+        self.generator = generator
+        self.item_cb = item_cb
+        self.buffer_size = buffer_size
+        self.count = 0
+
+    def run(self):
+        self.queue = Queue(self.buffer_size)
+        self.pause_event = Event()
+        self.cancel_event = Event()
+        self.thread = Thread(target=self._thread_manager)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.source_id = gobject.timeout_add(50, self._thread_receiver)
+
+    def pause(self):
+        self.pause_event.set()
+        lib.pause_downloads(self.thread.ident)
+
+    def resume(self):
+        self.pause_event.clear()
+        lib.resume_downloads(self.thread.ident)
+
+    def cancel(self):
+        self.cancel_event.set()
+        gobject.source_remove(self.source_id)
+        # Abort first, so downloads waiting for a resume are not restarted
+        lib.abort_downloads(self.thread.ident)
+        lib.resume_downloads(self.thread.ident)
+
+    def get_progress(self):
+        return self.count
+
+    def get_downloads(self):
+        """Return the downloads in progress (see lib.get_downloads)."""
+        thread = getattr(self, "thread", None)
+        return (lib.get_downloads(thread.ident) if thread else [])
+
+    @propagate_exceptions
+    def _thread_receiver(self):
+        if self.pause_event.isSet():
+            return True
+        # A fast generator refills the queue while it's consumed, so the
+        # values passed in a row are limited as for immediate tasks
+        for index in range(MAX_IMMEDIATE_STEPS):
+            try:
+                rtype, value = self.queue.get_nowait()
+            except Empty:
+                break
+            if rtype == "value":
+                self.count += 1
+                if self.item_cb:
+                    try:
+                        self.item_cb(value)
+                    except Exception:
+                        self.cancel()
+                        raise
+            elif rtype == "return":
+                self.return_cb(self.count)
+                return False
+            else:
+                self.exception_cb(value)
+                return False
+        if not self.thread.isAlive() and self.queue.empty():
+            self.exception_cb(TaskError('thread is dead but the queue is '
+                                        'empty'))
+            return False
+        return True
+
+    def _thread_manager(self):
+        try:
+            while 1:
+                while (self.pause_event.isSet() and
+                       not self.cancel_event.isSet()):
+                    time.sleep(0.1)
+                if self.cancel_event.isSet():
+                    self.generator.close()
+                    return
+                try:
+                    value = self.generator.next()
+                except StopIteration:
+                    self._put(("return", None))
+                    return
+                self._put(("value", value))
+        except Exception, exc:
+            if self.cancel_event.isSet():
+                # The downloads were aborted by cancel()
+                return
+            self._put(("exception", exc))
+            raise
+
+    def _put(self, item):
+        """Put an item in the queue, waiting while it's full (unless the
+        task is cancelled meanwhile)."""
+        while not self.cancel_event.isSet():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+
 def build_request(url, postdata=None):
     """Build a URL request with (optional) POST data"""
+    import urllib
+    import urllib2
     data = (urllib.urlencode(postdata) if postdata else None)
     return urllib2.Request(url, data)
 
 
-def connect_opener(url, opener=None, headers=None):
-    """Connect an opener to a url and return (response, content-length)."""
+def connect_opener(url, opener=None, headers=None,
+                   accept_encoding=lib.ACCEPT_ENCODING):
+    """Connect an opener to a url and return (response, content-length).
+    Compressed responses are accepted (see lib.Decompressor) unless
+    accept_encoding is None (i.e. for images, already compressed)."""
+    import urllib2
     opener = opener or urllib2.build_opener()
     request = (url if isinstance(url, urllib2.Request) else build_request(url))
+    if accept_encoding:
+        request.add_header("Accept-Encoding", accept_encoding)
     for key, value in (headers or {}).iteritems():
         request.add_header(key, value)
     response = opener.open(request)
@@ -329,21 +779,36 @@ class ProgressDownloadThreadedTask(Task):
     The task calls 'elapsed_cb' every time a chunk of data has been
     downloaded, the argument being (elapsed, total). Note that the total bytes
     field will only be set if the response contains a valid 'Content-Length'
-    header, otherwise it default to None.
+    header, otherwise it default to None. Compressed responses are
+    decompressed as they are downloaded, but elapsed and total count the
+    bytes transferred (as Content-Length does).
+
+    A stalled download (see Task.set_timeouts) is restarted with a new
+    connection up to 'reconnects' times before the task is aborted.
+
+    Compressed responses are requested unless accept_encoding is None (use
+    it for images, see connect_opener).
     """
+    uses_slot = True
+
     def __init__(self, url, opener=None, headers=None, elapsed_cb=None,
-                 chunk_size=1024):
+                 chunk_size=1024, reconnects=0,
+                 accept_encoding=lib.ACCEPT_ENCODING):
         self.url = url
         self.opener = opener
         self.headers = headers
+        self.accept_encoding = accept_encoding
         self.elapsed_cb = elapsed_cb
         self.chunk_size = chunk_size
+        self.reconnects = reconnects
         self.data = BytesIO()
+        self.response = None
 
     def run(self):
         self.queue = Queue()
         self.pause_event = Event()
         self.cancel_event = Event()
+        self.reconnect_event = Event()
         self.thread = Thread(target=self._thread_manager)
         self.thread.setDaemon(True)
         self.thread.start()
@@ -357,8 +822,24 @@ class ProgressDownloadThreadedTask(Task):
         self.pause_event.clear()
 
     def cancel(self):
+        """Stop the download, closing the connection (so a blocked read in
+        the thread returns at once)."""
         self.cancel_event.set()
         gobject.source_remove(self._thread_id)
+        if self.response:
+            lib.shutdown_response(self.response)
+
+    def get_progress(self):
+        return self.current_size
+
+    def reconnect(self):
+        """Close the stalled connection, the thread connects again."""
+        if self.reconnects <= 0 or not self.response:
+            return False
+        self.reconnects -= 1
+        self.reconnect_event.set()
+        lib.shutdown_response(self.response)
+        return True
 
     @propagate_exceptions
     def _thread_receiver(self):
@@ -382,41 +863,82 @@ class ProgressDownloadThreadedTask(Task):
                 self.exception_cb(result["exception"])
                 return False
             elif key == "data":
-                self.current_size += len(result["data"])
+                self.current_size += result["nbytes"]
                 if self.elapsed_cb:
                     self.elapsed_cb(self.current_size, result["size"])
-                if result["data"]:
-                    self.data.write(result["data"])
-                else:
-                    self.return_cb(self.data.getvalue())
-                    return False
+                self.data.write(result["data"])
+            elif key == "end":
+                self.return_cb(self.data.getvalue())
+                return False
             else:
                 raise ValueError("Unexpected message in queue")
         return True
 
     def _thread_manager(self):
         try:
-            request, size = connect_opener(self.url, self.opener, self.headers)
-            while 1:
-                data = request.read(self.chunk_size)
-                if self.cancel_event.isSet():
-                    self.queue.put(None)
-                    return
-                elif self.pause_event.isSet():
-                    # on pause, close current request and re-connect later
-                    request.close()
-                    while self.pause_event.isSet():
-                        if self.cancel_event.isSet():
-                            self.queue.put(None)
-                            return
-                        time.sleep(0.1)
-                    self.queue.put(dict(key="restart", size=size))
-                    request, size = connect_opener(self.url, self.opener,
-                                                   self.headers)
-                    continue
-                self.queue.put(dict(key="data", data=data, size=size))
-                if not data:
-                    break
+            self._download()
         except Exception, exc:
+            if self.cancel_event.isSet():
+                # The connection was closed by cancel()
+                self.queue.put(None)
+                return
             self.queue.put(dict(key="exception", exception=exc))
             raise
+
+    def _connect(self):
+        request, size = connect_opener(self.url, self.opener, self.headers,
+                                       self.accept_encoding)
+        self.response = request
+        self.size = size
+        decompressor = lib.Decompressor(request.info().get("Content-Encoding"))
+        return request, size, decompressor
+
+    def _download(self):
+        """Download the URL, the connection slot of the host (see
+        throttle.hosts) is released while the task is paused."""
+        while self._download_connected():
+            while self.pause_event.isSet():
+                if self.cancel_event.isSet():
+                    self.queue.put(None)
+                    return
+                time.sleep(0.1)
+            self.queue.put(dict(key="restart", size=self.size))
+
+    def _download_connected(self):
+        """Download holding a connection slot of the host. Return True if
+        the task was paused (the connection is closed, connect again on
+        resume)."""
+        with throttle.hosts.connection(self.url):
+            return self._read_response()
+
+    def _read_response(self):
+        request, size, decompressor = self._connect()
+        while 1:
+            # cancel() may have been called before the response was set
+            try:
+                data = (request.read(self.chunk_size)
+                        if not self.cancel_event.isSet() else None)
+            except Exception:
+                # reconnect() closes the connection under a blocked read
+                if not self.reconnect_event.isSet():
+                    raise
+            if self.cancel_event.isSet():
+                request.close()
+                self.queue.put(None)
+                return False
+            elif self.pause_event.isSet():
+                request.close()
+                return True
+            elif self.reconnect_event.isSet():
+                self.reconnect_event.clear()
+                self.queue.put(dict(key="restart", size=size))
+                request, size, decompressor = self._connect()
+                continue
+            elif not data:
+                self.queue.put(dict(key="data", data=decompressor.flush(),
+                                    nbytes=0, size=size))
+                self.queue.put(dict(key="end"))
+                return False
+            throttle.bandwidth.consume(len(data))
+            self.queue.put(dict(key="data", nbytes=len(data), size=size,
+                                data=decompressor.decompress(data)))
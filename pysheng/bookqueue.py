@@ -0,0 +1,119 @@
+#!/usr/bin/python
+"""
+Queue of books to download (used by the GUI), saved to a JSON file so the
+queue and the progress of each book survive a restart.
+"""
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+
+import lib
+import store
+
+
+class QueueItem:
+    """A book of the queue: what to download (url, pages from page_start
+    to page_end, 0-based and included, into destdir) and its progress.
+
+    States: queued, running, paused, finished, cancelled, error."""
+    FIELDS = ["url", "page_start", "page_end", "destdir", "state", "title",
+              "npages", "pages", "missing"]
+
+    def __init__(self, url, page_start=0, page_end=None, destdir=".",
+                 state="queued", title=None, npages=None, pages=0,
+                 missing=None):
+        self.url = url
+        self.page_start = page_start
+        self.page_end = page_end
+        self.destdir = destdir
+        self.state = state
+        self.title = title
+        self.npages = npages
+        self.pages = pages
+        self.missing = missing or []
+
+    def get_name(self):
+        return self.title or self.url
+
+    def get_progress(self):
+        """Return the fraction of pages done (0.0 if unknown)."""
+        if not self.npages:
+            return (1.0 if self.state == "finished" else 0.0)
+        return min(1.0, float(self.pages) / self.npages)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+
+class BookQueue:
+    """
+    Books to download (QueueItem objects, in order). If a path is given, the
+    queue is saved there every time it changes and loaded on start-up: books
+    that were running are queued again (pages already written are skipped
+    when they are downloaded again, see gui.download_pages).
+    """
+    def __init__(self, path=None):
+        self.path = (os.path.abspath(os.path.expanduser(path))
+                     if path else None)
+        self.items = []
+        self.load()
+
+    def add(self, url, page_start=0, page_end=None, destdir="."):
+        item = QueueItem(url, page_start, page_end, destdir)
+        self.items.append(item)
+        self.save()
+        return item
+
+    def remove(self, item):
+        self.items.remove(item)
+        self.save()
+
+    def update(self, item, save=True, **fields):
+        """Set fields of an item and save the queue (unless save is False,
+        then the fields are saved along with the next change)."""
+        for name, value in fields.iteritems():
+            if name not in QueueItem.FIELDS:
+                raise ValueError("Unknown field of a queue item: %s" % name)
+            setattr(item, name, value)
+        if save:
+            self.save()
+
+    def get_queued(self):
+        return [item for item in self.items if item.state == "queued"]
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        json = lib.import_json()
+        try:
+            records = json.loads(open(self.path).read())
+        except ValueError:
+            # A corrupted file only means an empty queue
+            return
+        for record in records:
+            fields = dict((str(name), value) for (name, value)
+                          in record.iteritems() if name in QueueItem.FIELDS)
+            item = QueueItem(**fields)
+            if item.state == "running":
+                item.state = "queued"
+            self.items.append(item)
+
+    def save(self):
+        if not self.path:
+            return
+        json = lib.import_json()
+        store.write_atomic(self.path, json.dumps(
+            [item.to_dict() for item in self.items], indent=1))
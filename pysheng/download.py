@@ -18,18 +18,22 @@
 import os
 import re
 import sys
+import time
 import itertools
-import HTMLParser
-
-try:
-    # Python >= 2.6
-    import json
-except ImportError:
-    import simplejson as json
+import collections
 
 import lib
+import metrics
+import sessions
+import throttle
 
 AGENT = "Chrome 5.0"
+BOOKS_URL = "http://books.google.com/books"
+
+# A page request that gets no data for TIMEOUT seconds is made again (up to
+# RECONNECTS times) before it fails, so a stalled connection cannot hang
+TIMEOUT = 60
+RECONNECTS = 2
 
 
 class ParsingError(Exception):
@@ -49,12 +53,12 @@ def get_id_from_string(s):
 
 
 def get_cover_url(book_id):
-    url = "http://books.google.com/books"
     return "%s?id=%s&hl=en&printsec=frontcover&source=gbs_ge_summary_r&cad=0" \
-           % (url, book_id)
+           % (BOOKS_URL, book_id)
 
 
 def get_unescape_entities(s):
+    import HTMLParser
     parser = HTMLParser.HTMLParser()
     return parser.unescape(s)
 
@@ -62,7 +66,10 @@ def get_unescape_entities(s):
 def get_info(cover_html):
     """Return dictionary with the book information.
 
-    Include the prefix, page_ids, title and attribution."""
+    Include the prefix, page_ids, title, attribution, max_resolution and
+    direct_images (whether images can be requested directly, see
+    get_direct_image_url)."""
+    json = lib.import_json()
     tag = lib.first(s for s in cover_html.split("<")
                     if re.search('input[^>]*\s+name="?ie"?', s))
     if tag:
@@ -96,6 +103,7 @@ def get_info(cover_html):
         "attribution": get_unescape_entities(re.sub("^By\s+", "",
                                                     book_info["attribution"])),
         "max_resolution": (mw, mh),
+        "direct_images": True,
     }
 
 
@@ -115,34 +123,432 @@ def get_page_url(prefix, page_id):
     return prefix + "&pg=" + page_id
 
 
+def get_direct_image_url(prefix, page_id, width):
+    """Return the image URL of a page built from the book prefix, the same
+    URL found in the page HTML (without the signature)."""
+    return "%s&pg=%s&img=1&zoom=3&w=%d" % (prefix, page_id, width)
+
+
+def get_store_key(book_id, page_id):
+    """Return the key of a page in a store.ImageStore."""
+    return "%s/%s" % (book_id, page_id)
+
+
 def download(*args, **kwargs):
     return lib.download(*args, **dict(kwargs, agent=AGENT))
 
 
-def get_info_from_url(url):
-    opener = lib.get_cookies_opener()
-    cover_url = get_cover_url(get_id_from_string(url))
-    cover_html = download(cover_url, opener=opener)
-    return get_info(cover_html)
-
+def fetch(phase, url, opener=None, book_id=None):
+    """Download a URL and emit its timing event (see metrics). Compressed
+    responses are requested, but for images. A download that times out is
+    made again (see TIMEOUT), and so is one interrupted by a pause (see
+    lib.pause_downloads), once resumed."""
+    accept_encoding = (None if phase == "image" else lib.ACCEPT_ENCODING)
+    reconnects = RECONNECTS
+    while 1:
+        lib.wait_while_paused()
+        try:
+            with metrics.timed(phase, url, book_id=book_id) as record:
+                data = download(url, opener=opener, timeout=TIMEOUT,
+                                accept_encoding=accept_encoding)
+                record["bytes"] = len(data)
+            return data
+        except lib.DownloadPaused:
+            continue
+        except Exception, exc:
+            if not lib.is_timeout(exc) or reconnects <= 0:
+                raise
+            reconnects -= 1
+
+
+def get_info_from_url(url, opener=None, info_cache=None):
+    """Return the book information (see get_info), from the info_cache
+    (a store.InfoCache) if given and the book is there. Stale entries are
+    revalidated with a conditional request of the cover."""
+    book_id = get_id_from_string(url)
+    entry = (info_cache and info_cache.get_entry(book_id))
+    if entry and not entry["stale"]:
+        return entry["info"]
+    opener = opener or lib.get_cookies_opener()
+    cover_url = get_cover_url(book_id)
+    with metrics.timed("cover", cover_url, book_id=book_id) as record:
+        cover_html, validators = lib.download_if_modified(
+            cover_url, (entry and entry["validators"]), opener=opener,
+            agent=AGENT)
+        record["bytes"] = len(cover_html or "")
+    if cover_html is None:
+        info_cache.touch(book_id)
+        return entry["info"]
+    info = get_info(cover_html)
+    if info_cache:
+        info_cache.put(book_id, info, validators)
+    return info
+
+
+def get_metadata(url, opener=None, info_cache=None):
+    """Return dictionary with the metadata of a book: book_id, title,
+    attribution, pages (number of pages) and max_resolution."""
+    info = get_info_from_url(url, opener=opener, info_cache=info_cache)
+    return dict(book_id=get_id_from_string(url), title=info["title"],
+                attribution=info["attribution"], pages=len(info["page_ids"]),
+                max_resolution=list(info["max_resolution"]))
+
+
+def get_direct_image(info, page_id, opener=None, book_id=None):
+    """Return the image data of a page requested directly (without fetching
+    the page HTML first), or None if the response is not an image (the page
+    is restricted or direct requests are not supported)."""
+    import urllib2
+    width, height = info["max_resolution"]
+    image_url = get_direct_image_url(info["prefix"], page_id, width)
+    try:
+        image_data = fetch("image", image_url, opener=opener,
+                           book_id=book_id)
+    except urllib2.URLError:
+        return
+    if lib.get_image_format(image_data):
+        return image_data
+
+
+def get_image_url(info, page_id, opener=None, book_id=None):
+    """Return the image URL of a page found in its HTML (None if the page
+    is restricted)."""
+    page_url = get_page_url(info["prefix"], page_id)
+    page_html = fetch("page_html", page_url, opener=opener, book_id=book_id)
+    image_url0 = get_image_url_from_page(page_html)
+    if image_url0:
+        width, height = info["max_resolution"]
+        return re.sub("w=(\d+)", "w=" + str(width), image_url0)
+
+
+def get_page_image(info, page_id, pool, book_id=None):
+    """Return the image data of a page, trying the active sessions of the
+    pool in turn. Return None if the page is restricted in all of them.
+    Sessions where the page was restricted are retired only if another
+    session serves it (see sessions.SessionPool).
+
+    The image is first requested directly; the page HTML is downloaded
+    only if that fails. If the page turns out to be available, direct
+    requests are not supported and are disabled for the rest of the book
+    (info["direct_images"])."""
+    restricted_openers = []
+    for opener in pool.rotation():
+        image_data = None
+        if info.get("direct_images", True):
+            image_data = get_direct_image(info, page_id, opener, book_id)
+        if image_data is None:
+            image_url = get_image_url(info, page_id, opener, book_id)
+            if image_url:
+                info["direct_images"] = False
+                image_data = fetch("image", image_url, opener=opener,
+                                   book_id=book_id)
+        if image_data is not None:
+            for restricted_opener in restricted_openers:
+                pool.retire(restricted_opener)
+            return image_data
+        restricted_openers.append(opener)
+
+
+def resolve_page(info, page_id, pool):
+    """Return the image URL of a page, trying the active sessions of the
+    pool in turn (see get_page_image). Return None if the page is
+    restricted in all of them."""
+    restricted_openers = []
+    for opener in pool.rotation():
+        image_url = get_image_url(info, page_id, opener)
+        if image_url:
+            for restricted_opener in restricted_openers:
+                pool.retire(restricted_opener)
+            return image_url
+        restricted_openers.append(opener)
+
+
+def resolve_book(url, page_start=0, page_end=None, pool=None, workers=4,
+                 info_cache=None):
+    """Yield a manifest record (a dictionary) for each page of the book
+       <url> from <page_start> to <page_end>, with the image URL of the
+       page (None if restricted). Images are not downloaded, and pages
+       are resolved by <workers> threads that share the sessions of pool.
+
+       Records: book_id, title, attribution, page (1-based, as in file
+       names), page_id, image_url, restricted and error (only if the page
+       could not be resolved, the other pages are resolved anyway)."""
+    from multiprocessing.pool import ThreadPool
+    pool = pool or sessions.SessionPool()
+    info = get_info_from_url(url, opener=pool.active[0],
+                             info_cache=info_cache)
+    book_id = get_id_from_string(url)
+    page_ids = list(itertools.islice(info["page_ids"], page_start, page_end))
+
+    def resolve(page_id):
+        try:
+            return resolve_page(info, page_id, pool), None
+        except Exception, exc:
+            return None, (str(exc) or exc.__class__.__name__)
+    threads = ThreadPool(workers)
+    try:
+        results = threads.imap(resolve, page_ids)
+        for page0, (page_id, (image_url, error)) in \
+                enumerate(itertools.izip(page_ids, results)):
+            record = dict(book_id=book_id, title=info["title"],
+                          attribution=info["attribution"],
+                          page=page_start + page0 + 1, page_id=page_id,
+                          image_url=image_url,
+                          restricted=(image_url is None and not error))
+            if error:
+                record["error"] = error
+            yield record
+    finally:
+        threads.terminate()
+
+
+def get_page_images(info, pages, pool, book_id=None, image_store=None,
+                    prefetch=0):
+    """Yield (page, page_id, image_data) for pages ((page, page_id)
+    tuples), image_data being None if the page is restricted (see
+    get_page_image). Pages in the image_store (if given) are read from
+    there.
+
+    With prefetch, a thread downloads up to that number of pages ahead
+    while a page is yielded (i.e. written). Its downloads are those of the
+    calling thread (see lib.set_download_owner)."""
+    def get(page_id):
+        if image_store:
+            digest = image_store.get_key(get_store_key(book_id, page_id))
+            if digest:
+                return image_store.read(digest)
+        return get_page_image(info, page_id, pool, book_id)
+    if not prefetch:
+        for page, page_id in pages:
+            yield page, page_id, get(page_id)
+        return
 
-def download_book(url, page_start=0, page_end=None):
+    from multiprocessing.pool import ThreadPool
+    owner = lib.get_download_owner()
+
+    def get_in_thread(page_id):
+        lib.set_download_owner(owner)
+        return get(page_id)
+    # A single thread, so sessions are used in the same order
+    threads = ThreadPool(1)
+    queued = collections.deque()
+    pages = iter(pages)
+    try:
+        while 1:
+            while len(queued) <= prefetch:
+                page, page_id = next(pages, (None, None))
+                if page is None:
+                    break
+                queued.append((page, page_id, threads.apply_async(
+                    get_in_thread, (page_id,))))
+            if not queued:
+                break
+            page, page_id, result = queued.popleft()
+            while not result.ready():
+                # Wait with a timeout, so the wait can be interrupted
+                result.wait(0.1)
+            yield page, page_id, result.get()
+    finally:
+        threads.terminate()
+
+
+def download_book(url, page_start=0, page_end=None, image_store=None,
+                  opener=None, info=None, pool=None, missing_pages=None,
+                  retries=1, retry_delay=0.0, skip_pages=None, prefetch=1):
     """Yield tuples (info, page, image_data) for each page of the book
-       <url> from <page_start> to <page_end>"""
-    info = get_info_from_url(url)
-    opener = lib.get_cookies_opener()
+       <url> from <page_start> to <page_end>, but those in skip_pages
+       (i.e. already written). Pages already in the image_store (if given)
+       are read from there. The next <prefetch> pages are downloaded while
+       a page is yielded (see get_page_images).
+
+       Pages are spread across the sessions of the pool (by default, a
+       single session using opener, which can be shared by many books).
+       Pages restricted in all sessions are deferred and retried at the end
+       (up to <retries> times, waiting <retry_delay> seconds and adding a
+       fresh session to the pool before each round). Pages still missing
+       are appended to missing_pages, so they are not yielded in order."""
+    pool = pool or sessions.SessionPool(openers=[opener or
+                                                 lib.get_cookies_opener()])
+    info = info or get_info_from_url(url, opener=pool.active[0])
+    book_id = get_id_from_string(url)
     page_ids = itertools.islice(info["page_ids"], page_start, page_end)
-
-    for page0, page_id in enumerate(page_ids):
-        page = page0 + page_start
-        page_url = get_page_url(info["prefix"], page_id)
-        page_html = download(page_url, opener=opener)
-        image_url0 = get_image_url_from_page(page_html)
-        if image_url0:
-            width, height = info["max_resolution"]
-            image_url = re.sub("w=(\d+)", "w=" + str(width), image_url0)
-            image_data = download(image_url, opener=opener)
-            yield info, page, image_data
+    pending = [(page0 + page_start, page_id)
+               for (page0, page_id) in enumerate(page_ids)
+               if page0 + page_start not in (skip_pages or ())]
+
+    for retry in range(retries + 1):
+        if retry:
+            if not pending:
+                break
+            time.sleep(retry_delay)
+            pool.add_session()
+        deferred = []
+        for page, page_id, image_data in get_page_images(
+                info, pending, pool, book_id, image_store, prefetch):
+            if image_data is not None:
+                yield info, page, image_data
+            else:
+                metrics.emit("deferred", book_id=book_id, page=page + 1,
+                             retry=retry)
+                deferred.append((page, page_id))
+        pending = deferred
+
+    for page, page_id in pending:
+        metrics.emit("restricted", book_id=book_id, page=page + 1)
+        if missing_pages is not None:
+            missing_pages.append(page)
+
+
+def add_metrics_hooks(jsonl_path=None, prometheus_path=None):
+    """Register the metrics hooks selected in the command line."""
+    if jsonl_path:
+        fileobj = (sys.stdout if jsonl_path == "-" else open(jsonl_path, "a"))
+        metrics.add_hook(metrics.JSONLinesHook(fileobj))
+    if prometheus_path:
+        metrics.add_hook(metrics.PrometheusHook(prometheus_path))
+
+
+def get_book_directory(base_directory, info):
+    return os.path.join(base_directory,
+                        "%(attribution)s - %(title)s" % info)
+
+
+def write_page(output_directory, book_id, page, page_id, image_data, args,
+               image_store=None):
+    """Write the image of a page (0-based) as NNN.ext in output_directory
+    (and to the image_store, if given) and return its path."""
+    image_format = lib.get_image_format(image_data, default="png")
+    filename = "%03d.%s" % (page + 1, image_format)
+    output_path = os.path.join(output_directory, filename)
+    if os.path.isfile(output_path) and args.noredownload:
+        if not args.quiet:
+            print 'Output file {} exists'.format(output_path.encode('utf-8'))
+        return output_path
+    with metrics.timed("write", output_path, book_id=book_id) as record:
+        if image_store:
+            image_store.write(output_path, image_data,
+                              get_store_key(book_id, page_id))
+        else:
+            open(output_path, "wb").write(image_data)
+        record["bytes"] = len(image_data)
+    metrics.emit("page", book_id=book_id, page=page + 1,
+                 bytes=len(image_data))
+    if not args.quiet:
+        print 'Downloaded {}'.format(output_path.encode('utf-8'))
+    return output_path
+
+
+def write_book(url, args, output_directory=None, base_directory="",
+               image_store=None, pool=None, info_cache=None):
+    """Download a book and write its pages to output_directory (by default,
+    a directory named after the book inside base_directory). Return the
+    list of pages (0-based) that could not be downloaded."""
+    pool = pool or sessions.SessionPool()
+    pool.reset()
+    info = get_info_from_url(url, opener=pool.active[0],
+                             info_cache=info_cache)
+    output_directory = (output_directory or
+                        get_book_directory(base_directory, info))
+    lib.mkdir_p(output_directory)
+    book_id = get_id_from_string(url)
+    missing_pages = []
+
+    with metrics.book(book_id):
+        for page_info, page, image_data in\
+                download_book(url, args.page_start - 1, args.page_end,
+                              image_store=image_store, pool=pool, info=info,
+                              missing_pages=missing_pages,
+                              retries=args.retries,
+                              retry_delay=args.retry_delay):
+            write_page(output_directory, book_id, page,
+                       page_info["page_ids"][page], image_data, args,
+                       image_store=image_store)
+    if missing_pages and not args.quiet:
+        sys.stderr.write("Missing pages (restricted): %s\n" %
+                         ", ".join(str(page + 1) for page in missing_pages))
+    return missing_pages
+
+
+def write_manifest(urls, args, pool=None, info_cache=None, fileobj=None):
+    """Write the manifest of the books (see resolve_book) as JSON lines."""
+    json = lib.import_json()
+    pool = pool or sessions.SessionPool()
+    fileobj = fileobj or sys.stdout
+    for url in urls:
+        pool.reset()
+        for record in resolve_book(url, args.page_start - 1, args.page_end,
+                                   pool=pool, workers=args.workers,
+                                   info_cache=info_cache):
+            fileobj.write(json.dumps(record) + "\n")
+            fileobj.flush()
+
+
+def write_metadata(urls, args, pool=None, info_cache=None, fileobj=None):
+    """
+    Write the metadata of the books (see get_metadata) as JSON lines, in
+    the same order, looking up args.workers books at a time. A book that
+    cannot be looked up gets a record with its url and an error field.
+    Return the number of errors.
+    """
+    from multiprocessing.pool import ThreadPool
+    json = lib.import_json()
+    pool = pool or sessions.SessionPool()
+    fileobj = fileobj or sys.stdout
+
+    def lookup(url):
+        try:
+            return get_metadata(url, opener=pool.get(),
+                                info_cache=info_cache)
+        except Exception, exc:
+            return dict(url=url, error=(str(exc) or exc.__class__.__name__))
+    threads = ThreadPool(args.workers)
+    errors = 0
+    try:
+        for record in threads.imap(lookup, urls):
+            errors += (1 if "error" in record else 0)
+            fileobj.write(json.dumps(record) + "\n")
+            fileobj.flush()
+    finally:
+        threads.terminate()
+    return errors
+
+
+def import_manifest(manifest_path, args, base_directory="",
+                    image_store=None):
+    """
+    Write the pages of a manifest whose images were downloaded elsewhere.
+    The path of the image of a record is taken from its "path" field, by
+    default <book_id>/<page_id>, relative to the directory of the manifest.
+    Books are written to directories inside base_directory. Return the
+    list of records whose image could not be found (or that have no image
+    URL: restricted pages or pages that could not be resolved).
+    """
+    json = lib.import_json()
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+    missing = []
+    for line in open(manifest_path):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if record.get("restricted") or not record.get("image_url"):
+            missing.append(record)
+            continue
+        path = os.path.join(manifest_directory, record.get("path") or
+                            get_store_key(record["book_id"],
+                                          record["page_id"]))
+        if not os.path.isfile(path):
+            missing.append(record)
+            continue
+        output_directory = get_book_directory(base_directory, record)
+        lib.mkdir_p(output_directory)
+        write_page(output_directory, record["book_id"], record["page"] - 1,
+                   record["page_id"], open(path, "rb").read(), args,
+                   image_store=image_store)
+    if missing and not args.quiet:
+        sys.stderr.write("Missing pages: %s\n" % ", ".join(
+            "%s/%d" % (record["book_id"], record["page"])
+            for record in missing))
+    return missing
 
 
 def main(args):
@@ -156,33 +562,137 @@ def main(args):
                         action="store_true", default=False,
                         help='Do not re-download pages if they exist locally')
     parser.add_argument('-o', '--output-directory', dest='output_directory',
-                        default='', help='Output directory')
+                        default='', help='Output directory (with many books, '
+                                         'directory where books are written)')
     parser.add_argument('-q', '--quiet', dest='quiet',
                         action="store_true", default=False,
                         help='Do not print messages to the terminal')
-    parser.add_argument('url', help='GOOGLE_BOOK_OR_ID')
+    parser.add_argument('--store', dest='store_directory', default=None,
+                        help='Content-addressed store shared by all books '
+                             '(page files are hardlinked into it)')
+    parser.add_argument('--session', dest='session_file', default=None,
+                        help='Cookies file to reuse the session between '
+                             'runs (it can be shared by many processes)')
+    parser.add_argument('--sessions', dest='sessions', type=int, default=1,
+                        help='Number of cookie sessions to spread pages '
+                             'across (restricted pages are retried on '
+                             'the other sessions)')
+    parser.add_argument('--retries', dest='retries', type=int, default=1,
+                        help='Times restricted pages are retried at the '
+                             'end of the book with a fresh session')
+    parser.add_argument('--retry-delay', dest='retry_delay', type=float,
+                        default=0.0, help='Cool-down before retrying '
+                                          'restricted pages (seconds)')
+    parser.add_argument('--resolve-only', dest='resolve_only',
+                        action="store_true", default=False,
+                        help='Do not download images, write instead a '
+                             'manifest of image URLs as JSON lines')
+    parser.add_argument('--metadata-only', dest='metadata_only',
+                        action="store_true", default=False,
+                        help='Write only the metadata of the books (title, '
+                             'attribution, pages, max_resolution) as JSON '
+                             'lines')
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+                        help='Pages resolved (--resolve-only) or books '
+                             'looked up (--metadata-only) in parallel')
+    parser.add_argument('--info-cache', dest='info_cache_directory',
+                        default=None, help='Directory where book '
+                                           'information is cached')
+    parser.add_argument('--info-max-age', dest='info_max_age', type=float,
+                        default=None, help='Revalidate cached book '
+                                           'information older than this '
+                                           '(seconds)')
+    parser.add_argument('--urls-file', dest='urls_file', default=None,
+                        help='Read more urls from a file, one per line '
+                             '(- for standard input)')
+    parser.add_argument('--import', dest='import_manifest', default=None,
+                        metavar='MANIFEST',
+                        help='Write pages from a manifest whose images were '
+                             'downloaded elsewhere (to <book_id>/<page_id>, '
+                             'unless the record has a path field)')
+    parser.add_argument('--limit-rate', dest='limit_rate',
+                        type=throttle.parse_rate, default=None,
+                        help='Bandwidth limit for all downloads, in bytes '
+                             'per second (suffixes k and M allowed)')
+    parser.add_argument('--max-per-host', dest='max_per_host', type=int,
+                        default=None, help='Simultaneous connections '
+                                           'allowed to each host')
+    parser.add_argument('--metrics-jsonl', dest='metrics_jsonl',
+                        default=None, help='Write timing events as JSON '
+                                           'lines to a file (- for stdout)')
+    parser.add_argument('--metrics-prometheus', dest='metrics_prometheus',
+                        default=None, help='Write summary counters to a '
+                                           'Prometheus text file')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        metavar='FILE', help='Profile the run, save the '
+                        'cProfile statistics to FILE and print a report of '
+                        'the time spent in each phase')
+    parser.add_argument('--profile-memory', dest='profile_memory',
+                        action="store_true", default=False,
+                        help='Include peak memory in the profile report')
+    parser.add_argument('urls', metavar='url', nargs='*',
+                        help='GOOGLE_BOOK_OR_ID')
     args = parser.parse_args(args)
-
-    url = args.url
-    info = get_info_from_url(url)
-    namespace = dict(title=info["title"], attribution=info["attribution"])
-    if args.output_directory:
-        output_directory = args.output_directory
+    if args.urls_file:
+        urls_file = (sys.stdin if args.urls_file == "-"
+                     else open(args.urls_file))
+        args.urls.extend(line.strip() for line in urls_file if line.strip())
+    if not args.urls and not args.import_manifest:
+        parser.error("at least one url is required")
+    add_metrics_hooks(args.metrics_jsonl, args.metrics_prometheus)
+    throttle.configure(args.limit_rate, args.max_per_host)
+    if args.profile:
+        import profiling
+        with profiling.profile(args.profile, memory=args.profile_memory):
+            return run(args)
+    return run(args)
+
+
+def run(args):
+    """Run the command line (see main) with the parsed arguments."""
+    if args.store_directory:
+        from store import ImageStore
+        image_store = ImageStore(args.store_directory)
     else:
-        output_directory = "%(attribution)s - %(title)s" % namespace
-    lib.mkdir_p(output_directory)
-
-    for page_info, page, image_data in\
-            download_book(url, args.page_start - 1, args.page_end):
-        filename = "%03d.png" % (page + 1)
-        output_path = os.path.join(output_directory, filename)
-        if not ((os.path.isfile(output_path) and
-                 args.noredownload)):
-            open(output_path, "wb").write(image_data)
-            if not args.quiet:
-                print 'Downloaded {}'.format(output_path.encode('utf-8'))
-        elif not args.quiet:
-            print 'Output file {} exists'.format(output_path.encode('utf-8'))
+        image_store = None
+    if args.info_cache_directory:
+        from store import InfoCache
+        info_cache = InfoCache(args.info_cache_directory,
+                               max_age=args.info_max_age)
+    else:
+        info_cache = None
+    if args.session_file:
+        session_store = sessions.SessionStore(args.session_file)
+        opener = session_store.get_opener()
+    else:
+        session_store = None
+        opener = lib.get_cookies_opener()
+    pool = sessions.SessionPool(args.sessions, openers=[opener])
+
+    if args.import_manifest:
+        import_manifest(args.import_manifest, args,
+                        base_directory=args.output_directory,
+                        image_store=image_store)
+    if args.resolve_only or args.metadata_only:
+        write = (write_metadata if args.metadata_only else write_manifest)
+        try:
+            errors = write(args.urls, args, pool=pool, info_cache=info_cache)
+        finally:
+            if session_store:
+                session_store.save(opener)
+        return (1 if errors else 0)
+
+    for url in args.urls:
+        if len(args.urls) == 1:
+            directories = dict(output_directory=args.output_directory)
+        else:
+            directories = dict(base_directory=args.output_directory)
+        try:
+            write_book(url, args, image_store=image_store, pool=pool,
+                       info_cache=info_cache, **directories)
+        finally:
+            if session_store:
+                session_store.save(opener)
 
 
 if __name__ == '__main__':
@@ -22,21 +22,66 @@ import time
 import glob
 import traceback
 import functools
-import StringIO
+import collections
 import string
-import imghdr
 
 import gtk
 import gtk.glade
 import gobject
 
 from pysheng import lib
+from pysheng import metrics
+from pysheng import bookqueue
+from pysheng import sessions
+from pysheng import throttle
+from pysheng import thumbnails
 from pysheng import asyncjobs
 from pysheng.yieldfrom import supergenerator, _from
 import pysheng
 
+# Worker threads (asyncjobs tasks, thumbnails.ThumbnailLoader) only run
+# while gtk.main() waits if thread support is enabled before it's started
+gobject.threads_init()
+
 HEADERS = {"User-Agent": pysheng.AGENT}
 
+# A download that gets no data for STALL_TIMEOUT seconds is restarted (up
+# to STALL_RECONNECTS times) and then aborted, so the job does not hang
+STALL_TIMEOUT = 60
+STALL_RECONNECTS = 2
+
+# Pages the download thread can get ahead of the interface
+PAGES_BUFFER_SIZE = 4
+
+QUEUE_FILE = "~/.pysheng-queue.json"
+
+# The progress of a book of the queue is saved every QUEUE_SAVE_PAGES pages
+# (changes of state are saved at once)
+QUEUE_SAVE_PAGES = 10
+
+# Lines kept in the log view (older ones are removed)
+MAX_LOG_LINES = 1000
+
+# Milliseconds between redraws of the progress bars
+PROGRESS_INTERVAL = 250
+
+# Size (pixels) of the thumbnails of the pages and how many are kept
+THUMBNAIL_SIZE = 96
+MAX_THUMBNAILS = 200
+
+
+def get_opener(state):
+    """Return an opener, using the saved session if there is one."""
+    if state.session_store:
+        return state.session_store.get_opener()
+    else:
+        return lib.get_cookies_opener()
+
+
+def save_session(state, opener):
+    if state.session_store:
+        state.session_store.save(opener)
+
 
 def get_max_filename_length():
     fd = os.open(".", os.O_RDONLY)
@@ -50,18 +95,22 @@ class State:
         self.check_job = None
         self.downloaded_images = None
         self.pdf_filename = None
+        self.image_store = None
+        self.session_store = None
+        self.nsessions = 1
+        self.retries = 1
+        self.retry_delay = 0.0
+        self.prefetch = True
+        self.queue = bookqueue.BookQueue()
+        self.scheduler = None
+        self.queue_entries = {}
 
 
 def restart_buttons(widgets):
     set_sensitivity(widgets, check=True, start=True, pause=False, cancel=False)
     set_sensitivity(widgets, url=True, browse_destdir=True, page_start=True,
                     page_end=True)
-    widgets.progress_current.set_fraction(0.0)
-    widgets.progress_current.set_text("")
-
-
-def createfile(output_path, image_data):
-    open(output_path, "wb").write(image_data)
+    widgets.progress.set_current(None)
 
 
 def set_sensitivity(widgets, **kwargs):
@@ -69,14 +118,254 @@ def set_sensitivity(widgets, **kwargs):
         getattr(widgets, key).set_sensitive(value)
 
 
-def get_debug_func(widgets):
-    buf = widgets.log.get_buffer()
-
-    def _debug(line):
+class LogView:
+    """
+    Log lines to a gtk.TextView. Lines logged in a main loop iteration are
+    inserted at once (and the view scrolled once) when the loop is idle,
+    and only the last max_lines lines are kept. All lines are also written
+    to fileobj, if given.
+    """
+    def __init__(self, textview, max_lines=MAX_LOG_LINES, fileobj=None):
+        self.textview = textview
+        self.max_lines = max_lines
+        self.fileobj = fileobj
+        self.pending = collections.deque(maxlen=max_lines)
+        self.source_id = None
+        buf = textview.get_buffer()
+        self.end_mark = buf.create_mark("end", buf.get_end_iter(), False)
+
+    def __call__(self, line):
         stime = time.strftime("%H:%M:%S", time.localtime())
-        buf.insert(buf.get_end_iter(), "[%s] %s\n" % (stime, line))
-        widgets.log.scroll_to_iter(buf.get_end_iter(), 0)
-    return _debug
+        text = "[%s] %s\n" % (stime, line)
+        if self.fileobj:
+            self.fileobj.write(text)
+        self.pending.append(text)
+        if self.source_id is None:
+            self.source_id = gobject.idle_add(self.flush)
+
+    def flush(self):
+        self.source_id = None
+        if self.fileobj:
+            self.fileobj.flush()
+        buf = self.textview.get_buffer()
+        buf.insert(buf.get_end_iter(), "".join(self.pending))
+        self.pending.clear()
+        # The buffer ends with an empty line (after the last newline)
+        excess_lines = buf.get_line_count() - 1 - self.max_lines
+        if excess_lines > 0:
+            buf.delete(buf.get_start_iter(),
+                       buf.get_iter_at_line(excess_lines))
+        buf.move_mark(self.end_mark, buf.get_end_iter())
+        self.textview.scroll_mark_onscreen(self.end_mark)
+        return False
+
+
+def format_rate(bytes_per_second):
+    for unit in ["B", "KB", "MB"]:
+        if bytes_per_second < 1024 or unit == "MB":
+            return "%.1f %s/s" % (bytes_per_second, unit)
+        bytes_per_second /= 1024.0
+
+
+class ProgressView:
+    """
+    Show the progress of the current download (progress_current) and of
+    the pages of the book (progress_all). Callbacks only record the state,
+    the progress bars are redrawn at most every interval milliseconds with
+    the throughput (a moving average, see metrics.Throughput) and the
+    estimated time left of the book.
+    """
+    def __init__(self, widgets, interval=PROGRESS_INTERVAL):
+        self.widgets = widgets
+        self.interval = interval
+        self.current = None
+        self.pages = None
+        self.done_text = None
+        self.throughput = None
+        self.source_id = None
+        self.watch_id = None
+
+    def set_current(self, current):
+        """Set the current download: (name, elapsed, total) or None."""
+        self.current = current
+        self._changed()
+
+    def set_pages(self, pages, npages):
+        self.pages = (pages, npages)
+        self.done_text = None
+        self._changed()
+
+    def set_done(self, text):
+        self.done_text = text
+        self._changed()
+
+    def clear_pages(self):
+        self.pages = self.done_text = None
+        self._changed()
+
+    def measure(self, book_id=None):
+        """Start measuring the throughput of a book (until stop_measure is
+        called)."""
+        self.stop_measure()
+        self.throughput = metrics.Throughput(book_id=book_id)
+        metrics.add_hook(self.throughput)
+
+    def stop_measure(self):
+        if self.throughput:
+            metrics.remove_hook(self.throughput)
+            self.throughput = None
+
+    def watch_downloads(self, task):
+        """Show the download in progress of a task (see
+        asyncjobs.ThreadedGeneratorTask.get_downloads) as the current one,
+        until it's called with None."""
+        if self.watch_id is not None:
+            gobject.source_remove(self.watch_id)
+            self.watch_id = None
+        if task:
+            self.watch_id = gobject.timeout_add(self.interval,
+                                                self._watch_downloads, task)
+
+    def _watch_downloads(self, task):
+        downloads = task.get_downloads()
+        if downloads:
+            # The first one is the current page, the others are prefetched
+            download = downloads[0]
+            self.set_current(("page", download["received"], download["size"]))
+        return True
+
+    def _changed(self):
+        if self.source_id is None:
+            self.source_id = gobject.timeout_add(self.interval, self.redraw)
+
+    def redraw(self):
+        self.source_id = None
+        progress = self.widgets.progress_current
+        if self.current is None:
+            progress.set_fraction(0.0)
+            progress.set_text("")
+        else:
+            name, elapsed, total = self.current
+            if total is not None:
+                progress.set_fraction(float(elapsed) / total)
+                name += " (%d bytes)" % total
+            else:
+                progress.pulse()
+            progress.set_text("Downloading %s..." % name)
+        progress = self.widgets.progress_all
+        if self.done_text is not None:
+            progress.set_fraction(1.0)
+            progress.set_text(self.done_text)
+        elif self.pages is None:
+            progress.set_fraction(0.0)
+            progress.set_text("")
+        else:
+            pages, npages = self.pages
+            progress.set_fraction(float(pages) / npages)
+            texts = (["Total: %d%%" % (100 * pages / npages)] +
+                     self.get_rates_text(npages - pages))
+            progress.set_text(" - ".join(texts))
+        return False
+
+    def get_rates_text(self, pages_left):
+        """Return the throughput and the time left as a list of strings."""
+        if not self.throughput:
+            return []
+        bytes_per_second, pages_per_minute = self.throughput.get_rates()
+        texts = ["%s, %.1f pages/min" % (format_rate(bytes_per_second),
+                                         pages_per_minute)]
+        if pages_per_minute > 0 and pages_left > 0:
+            seconds = int(60 * pages_left / pages_per_minute)
+            texts.append("%d:%02d left" % (seconds // 60, seconds % 60))
+        return texts
+
+
+class ThumbnailView:
+    """
+    Thumbnails of the downloaded pages in a gtk.IconView. Only the visible
+    pages are decoded (in a background thread, at most size pixels wide
+    and high) and only max_thumbnails are kept, other pages show an empty
+    image. Pages that cannot be decoded show a missing image icon.
+    """
+    def __init__(self, iconview, size=THUMBNAIL_SIZE,
+                 max_thumbnails=MAX_THUMBNAILS):
+        self.iconview = iconview
+        self.size = size
+        self.model = gtk.ListStore(gtk.gdk.Pixbuf, str)
+        self.empty = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, True, 8,
+                                    size, size)
+        self.empty.fill(0)
+        self.missing = iconview.render_icon(gtk.STOCK_MISSING_IMAGE,
+                                            gtk.ICON_SIZE_DIALOG)
+        self.paths = []
+        self.generation = 0
+        self.source_id = None
+        self.cache = thumbnails.LRUCache(max_thumbnails, self._evicted)
+        self.loader = thumbnails.ThumbnailLoader(self._decode, self._loaded)
+        iconview.set_model(self.model)
+        iconview.set_pixbuf_column(0)
+        iconview.set_text_column(1)
+        iconview.set_item_width(size)
+        iconview.connect("size-allocate", self._changed)
+        adjustment = iconview.get_parent().get_vadjustment()
+        adjustment.connect("value-changed", self._changed)
+        adjustment.connect("changed", self._changed)
+
+    def set_images(self, paths):
+        """Show the pages of image paths (empty to clear the view)."""
+        self.generation += 1
+        self.paths = list(paths)
+        self.cache.clear()
+        self.loader.request([])
+        # Fill the model detached from the view (faster for many pages)
+        self.iconview.set_model(None)
+        self.model.clear()
+        for path in self.paths:
+            name = os.path.splitext(os.path.basename(path))[0]
+            self.model.append((self.empty, name))
+        self.iconview.set_model(self.model)
+        self._changed()
+
+    def stop(self):
+        self.loader.stop()
+
+    def _changed(self, *args):
+        if self.source_id is None:
+            self.source_id = gobject.idle_add(self._load_visible)
+
+    def _load_visible(self):
+        self.source_id = None
+        visible_range = self.iconview.get_visible_range()
+        if not visible_range:
+            return False
+        (first,), (last,) = visible_range
+        keys = []
+        for index in range(first, last + 1):
+            # Mark the visible thumbnails as recently used
+            if self.cache.get(index) is None:
+                keys.append((self.generation, index, self.paths[index]))
+        self.loader.request(keys)
+        return False
+
+    def _decode(self, key):
+        generation, index, path = key
+        return gtk.gdk.pixbuf_new_from_file_at_size(path, self.size,
+                                                     self.size)
+
+    def _loaded(self, key, pixbuf):
+        # Called by the thread of the loader
+        gobject.idle_add(self._set_thumbnail, key, pixbuf)
+
+    def _set_thumbnail(self, key, pixbuf):
+        generation, index, path = key
+        if generation == self.generation:
+            pixbuf = (pixbuf or self.missing)
+            self.cache.put(index, pixbuf)
+            self.model[index][0] = pixbuf
+        return False
+
+    def _evicted(self, index, pixbuf):
+        self.model[index][0] = self.empty
 
 
 def adj_int(value, adjvalue, default=None):
@@ -103,13 +392,29 @@ def string_to_valid_filename(s, lengthlimit=240):
     return "".join(c for c in s if c not in forbidden_chars)[-lengthlimit:]
 
 
+def get_book_dirname(info):
+    return string_to_valid_filename("%(attribution)s - %(title)s" % info)
+
+
+def get_page_range(widgets):
+    """Return (page_start, page_end) from the page entries (0-based)."""
+    page_start = (int(widgets.page_start.get_text())-1
+                  if widgets.page_start.get_text() else 0)
+    page_end = (int(widgets.page_end.get_text())-1
+                if widgets.page_end.get_text() else None)
+    return page_start, page_end
+
+
 def on_elapsed(widgets, name, elapsed, total):
-    if total is not None:
-        widgets.progress_current.set_fraction(float(elapsed)/total)
-        name += " (%d bytes)" % total
-    else:
-        widgets.progress_current.pulse()
-    widgets.progress_current.set_text("Downloading %s..." % name)
+    widgets.progress.set_current((name, elapsed, total))
+
+
+def download_task(widgets, name, url, opener):
+    """Return a task that downloads url and shows its progress."""
+    task = asyncjobs.ProgressDownloadThreadedTask(
+        url, opener, headers=HEADERS, reconnects=STALL_RECONNECTS,
+        elapsed_cb=functools.partial(on_elapsed, widgets, name))
+    return task.set_timeouts(stall_timeout=STALL_TIMEOUT)
 
 
 def escape_glob(path):
@@ -122,9 +427,9 @@ def escape_glob(path):
 
 def get_info(widgets, url, opener):
     debug = widgets.debug
-    html = yield asyncjobs.ProgressDownloadThreadedTask(
-        url, opener, headers=HEADERS,
-        elapsed_cb=functools.partial(on_elapsed, widgets, "info"))
+    with metrics.timed("cover", url) as record:
+        html = yield download_task(widgets, "info", url, opener)
+        record["bytes"] = len(html)
     try:
         info = pysheng.get_info(html)
     except ValueError, detail:
@@ -137,6 +442,60 @@ def get_info(widgets, url, opener):
     raise StopIteration(info)
 
 
+def get_existing_image(output_path):
+    """Return the path of an image already downloaded (None if none)."""
+    existing_files = glob.glob(escape_glob(output_path) + ".*")
+    if existing_files:
+        return existing_files[0]
+
+
+def get_existing_pages(page_start, page_end, output_directory, page_cb):
+    """Call page_cb((page, image_path)) for each page from page_start to
+    page_end (excluded) already in output_directory and return them (a
+    set). The files are checked in the job itself, an ImmediateTask per
+    page, so existing pages do not wait for the download thread and the
+    main loop still runs now and then."""
+    existing_pages = set()
+    for page in range(page_start, page_end):
+        output_path = os.path.join(output_directory, "%03d" % (page + 1))
+        image_path = yield asyncjobs.ImmediateTask(
+            get_existing_image(output_path))
+        if image_path:
+            existing_pages.add(page)
+            page_cb((page, image_path))
+    raise StopIteration(existing_pages)
+
+
+def download_pages(state, url, info, pool, page_start, page_end,
+                   output_directory, missing_pages, existing_pages=None):
+    """Download pages from page_start to page_end (excluded) with
+    download.download_book and write them in output_directory, but
+    existing_pages (see get_existing_pages). Yield (page, image_path) for
+    each page. Restricted pages are appended to missing_pages. With
+    state.prefetch, the next page is downloaded while one is written.
+
+    This generator blocks, run it with asyncjobs.ThreadedGeneratorTask."""
+    args = lib.Struct(noredownload=False, quiet=True)
+    book_id = pysheng.get_id_from_string(url)
+    for page_info, page, image_data in pysheng.download_book(
+            url, page_start, page_end, image_store=state.image_store,
+            info=info, pool=pool, missing_pages=missing_pages,
+            retries=state.retries, retry_delay=state.retry_delay,
+            skip_pages=existing_pages, prefetch=(1 if state.prefetch else 0)):
+        image_path = pysheng.write_page(
+            output_directory, book_id, page, info["page_ids"][page],
+            image_data, args, image_store=state.image_store)
+        yield page, image_path
+
+
+def on_page(widgets, images, npages, item):
+    page, image_path = item
+    images.append(item)
+    widgets.debug("[%d/%d] Page %d: %s" % (len(images), npages, page + 1,
+                                           image_path))
+    widgets.progress.set_pages(len(images), npages)
+
+
 @supergenerator
 def download_book(widgets, state, url, page_start=0, page_end=None):
     """Yield (info, page, image_data) for pages from page_start to page_end"""
@@ -150,14 +509,14 @@ def download_book(widgets, state, url, page_start=0, page_end=None):
         debug("Output directory: %s" % destdir)
         debug("Page_start: %s, Page end: %s" %
               (adj_int(page_start, +1, 1), adj_int(page_end, +1, "last")))
-        opener = lib.get_cookies_opener()
+        opener = get_opener(state)
         book_id = pysheng.get_id_from_string(url)
         debug("Book ID: %s" % book_id)
         cover_url = pysheng.get_cover_url(book_id)
-        widgets.progress_all.set_fraction(0.0)
-        widgets.progress_all.set_text('')
+        widgets.progress.clear_pages()
         widgets.progress_current.set_pulse_step(0.04)
         state.downloaded_images = None
+        widgets.thumbnail_view.set_images([])
         info = yield _from(get_info(widgets, cover_url, opener))
 
         if not widgets.page_start.get_text():
@@ -166,62 +525,44 @@ def download_book(widgets, state, url, page_start=0, page_end=None):
             widgets.page_end.set_text(str(len(info["page_ids"])))
         page_ids = info["page_ids"][page_start:adj_int(page_end, +1)]
         namespace = dict(title=info["title"], attribution=info["attribution"])
-        dirname = string_to_valid_filename("%(attribution)s - %(title)s" %
-                                           namespace)
-        output_directory = os.path.join(destdir, dirname)
+        output_directory = os.path.join(destdir, get_book_dirname(namespace))
         lib.mkdir_p(output_directory)
+        pool = sessions.SessionPool(state.nsessions, openers=[opener])
         images = []
-
-        for page, page_id in enumerate(page_ids):
-            page += page_start
-            filename = "%(page)03d" % dict(namespace, page=page+1)
-            output_path = os.path.join(output_directory, filename)
-            existing_files = glob.glob(escape_glob(output_path) + ".*")
-            if existing_files:
-                debug("Skip existing image: %s" % existing_files[0])
-                images.append(existing_files[0])
-                continue
-            relative_page = page - page_start + 1
-            widgets.progress_all.set_fraction(float(relative_page-1) /
-                                              len(page_ids))
-            widgets.progress_all.set_text(
-                "Total: %d%%" % (int(100*float(relative_page-1) /
-                                 len(page_ids))))
-            header = "[%d/%d] " % (relative_page, len(page_ids))
-            debug(header + "Start page: %d (page_id: %s)" % (page+1, page_id))
-            page_url = pysheng.get_page_url(info["prefix"], page_id)
-            debug(header + "Download page contents: %s" % (page_url))
-            widgets.progress_current.set_fraction(0.0)
-            page_html = yield asyncjobs.ProgressDownloadThreadedTask(
-                page_url, opener, headers=HEADERS,
-                elapsed_cb=functools.partial(on_elapsed, widgets, "page"))
-
-            image_url0 = pysheng.get_image_url_from_page(page_html)
-            if not image_url0:
-                debug("No image for this page, access may be restricted")
-            else:
-                width, height = info["max_resolution"]
-                image_url = re.sub("w=(\d+)", "w=" + str(width), image_url0)
-                debug(header + "Download page image: %s" % image_url)
-                widgets.progress_current.set_fraction(0.0)
-                image_data = yield asyncjobs.ProgressDownloadThreadedTask(
-                    image_url, opener, headers=HEADERS,
-                    elapsed_cb=functools.partial(on_elapsed, widgets, "image"))
-                image_format = imghdr.what(StringIO.StringIO(image_data)) or \
-                    "png"
-                debug(header + "Image downloaded (size=%d, format=%s)" %
-                      (len(image_data), image_format))
-                output_path_with_extension = output_path + "." + image_format
-                createfile(output_path_with_extension, image_data)
-                debug(header + "Image written: %s" %
-                      output_path_with_extension)
-                images.append(output_path_with_extension)
-
-        widgets.progress_all.set_fraction(1.0)
-        widgets.progress_all.set_text("Done")
+        missing_pages = []
+
+        if page_ids:
+            widgets.progress.set_current(("pages", 0, None))
+            widgets.progress.set_pages(0, len(page_ids))
+            widgets.progress.measure(book_id)
+            page_cb = functools.partial(on_page, widgets, images,
+                                        len(page_ids))
+            existing_pages = yield _from(get_existing_pages(
+                page_start, page_start + len(page_ids), output_directory,
+                page_cb))
+            task = asyncjobs.ThreadedGeneratorTask(
+                download_pages(state, url, info, pool, page_start,
+                               page_start + len(page_ids),
+                               output_directory, missing_pages,
+                               existing_pages),
+                item_cb=page_cb, buffer_size=PAGES_BUFFER_SIZE)
+            widgets.progress.watch_downloads(task)
+            try:
+                with metrics.book(book_id):
+                    yield task
+            finally:
+                widgets.progress.watch_downloads(None)
+                widgets.progress.stop_measure()
+
+        save_session(state, opener)
+        if missing_pages:
+            debug("Missing pages (restricted): %s" %
+                  ", ".join(str(page + 1) for page in sorted(missing_pages)))
+        widgets.progress.set_done("Done")
         debug("Done!")
         restart_buttons(widgets)
-        state.downloaded_images = images
+        state.downloaded_images = [path for (page, path) in sorted(images)]
+        widgets.thumbnail_view.set_images(state.downloaded_images)
 
         if namespace["attribution"]:
             state.pdf_filename = "%(attribution)s - %(title)s.pdf" % namespace
@@ -237,17 +578,18 @@ def download_book(widgets, state, url, page_start=0, page_end=None):
 
 
 @supergenerator
-def check_book(widgets, url):
+def check_book(widgets, state, url):
     set_sensitivity(widgets, url=False, check=False, start=False, cancel=True)
     debug = widgets.debug
     debug("Checking book: %s" % url)
     try:
-        opener = lib.get_cookies_opener()
+        opener = get_opener(state)
         book_id = pysheng.get_id_from_string(url)
         debug("Book ID: %s" % book_id)
         cover_url = pysheng.get_cover_url(book_id)
         set_book_info(widgets, None)
         info = yield _from(get_info(widgets, cover_url, opener))
+        save_session(state, opener)
         widgets.page_start.set_text(str(1))
         widgets.page_end.set_text(str(len(info["page_ids"])))
         debug("Check book done")
@@ -260,6 +602,96 @@ def check_book(widgets, url):
         debug("Check book error")
         restart_buttons(widgets)
 
+
+@supergenerator
+def download_queue_item(widgets, state, item):
+    """Download a book of the queue (a bookqueue.QueueItem)."""
+    def update(save=True, **fields):
+        state.queue.update(item, save=save, **fields)
+        update_queue_row(widgets, state, item)
+
+    def on_queue_page(page_and_path):
+        pages = item.pages + 1
+        update(save=(pages % QUEUE_SAVE_PAGES == 0), pages=pages)
+    try:
+        update(state="running")
+        widgets.debug("Queue: start %s" % item.url)
+        opener = get_opener(state)
+        info = yield asyncjobs.ThreadedTask(pysheng.get_info_from_url,
+                                            item.url, opener)
+        page_ids = info["page_ids"][item.page_start:
+                                    adj_int(item.page_end, +1)]
+        update(title=info["title"], npages=len(page_ids), pages=0)
+        output_directory = os.path.join(item.destdir, get_book_dirname(info))
+        lib.mkdir_p(output_directory)
+        pool = sessions.SessionPool(state.nsessions, openers=[opener])
+        missing_pages = []
+        existing_pages = yield _from(get_existing_pages(
+            item.page_start, item.page_start + len(page_ids),
+            output_directory, on_queue_page))
+        yield asyncjobs.ThreadedGeneratorTask(
+            download_pages(state, item.url, info, pool, item.page_start,
+                           item.page_start + len(page_ids),
+                           output_directory, missing_pages, existing_pages),
+            item_cb=on_queue_page,
+            buffer_size=PAGES_BUFFER_SIZE)
+        save_session(state, opener)
+        update(state="finished", missing=sorted(missing_pages))
+        widgets.debug("Queue: %s done" % item.get_name())
+    except asyncjobs.JobCancelled:
+        return
+    except Exception, detail:
+        traceback.print_exc()
+        update(state="error")
+        widgets.debug("Queue: %s error: %s" % (item.get_name(), detail))
+
+
+def queue_view_init(widgets):
+    """Add the columns of the queue view (book, progress, state)."""
+    widgets.queue.set_model(gtk.ListStore(str, int, str))
+    for index, (title, renderer, attribute) in enumerate([
+            ("Book", gtk.CellRendererText(), "text"),
+            ("Progress", gtk.CellRendererProgress(), "value"),
+            ("State", gtk.CellRendererText(), "text")]):
+        column = gtk.TreeViewColumn(title, renderer, **{attribute: index})
+        column.set_expand(index == 0)
+        widgets.queue.append_column(column)
+
+
+def update_queue_row(widgets, state, item):
+    if item not in state.queue.items:
+        return
+    index = state.queue.items.index(item)
+    state_text = item.state
+    if item.missing:
+        state_text += " (%d missing)" % len(item.missing)
+    widgets.queue.get_model()[index] = (item.get_name(),
+                                        int(100 * item.get_progress()),
+                                        state_text)
+
+
+def start_queue_item(widgets, state, item):
+    """Add a book of the queue to the scheduler."""
+    state.queue.update(item, state="queued")
+    update_queue_row(widgets, state, item)
+    state.queue_entries[item] = state.scheduler.add(
+        download_queue_item(widgets, state, item), name=item.url)
+
+
+def get_selected_queue_item(state, widgets):
+    model, tree_iter = widgets.queue.get_selection().get_selected()
+    if tree_iter:
+        return state.queue.items[model.get_path(tree_iter)[0]]
+
+
+def cancel_queue_item(widgets, state, item):
+    entry = state.queue_entries.pop(item, None)
+    if entry and entry.get_state() in ("queued", "running", "paused"):
+        state.scheduler.cancel(entry)
+    if item.state in ("queued", "running", "paused"):
+        state.queue.update(item, state="cancelled")
+        update_queue_row(widgets, state, item)
+
 # Widget callbacks
 
 
@@ -270,10 +702,7 @@ def on_start__clicked(button, widgets, state):
         widgets.debug("Job resumed")
         return
     url = widgets.url.get_text()
-    page_start = (int(widgets.page_start.get_text())-1
-                  if widgets.page_start.get_text() else 0)
-    page_end = (int(widgets.page_end.get_text())-1
-                if widgets.page_end.get_text() else None)
+    page_start, page_end = get_page_range(widgets)
     gen = download_book(widgets, state, url, page_start=page_start,
                         page_end=page_end)
     state.download_job = asyncjobs.Job(gen)
@@ -287,7 +716,7 @@ def on_pause__clicked(button, widgets, state):
 
 def on_check__clicked(button, widgets, state):
     url = widgets.url.get_text()
-    state.check_job = asyncjobs.Job(check_book(widgets, url))
+    state.check_job = asyncjobs.Job(check_book(widgets, state, url))
 
 
 def on_url__changed(entry, widgets, state):
@@ -310,9 +739,64 @@ def on_page_end__activate(entry, widgets, state):
         return on_start__clicked(None, widgets, state)
 
 
+def on_queue_add__clicked(button, widgets, state):
+    url = widgets.url.get_text()
+    if not url:
+        return
+    page_start, page_end = get_page_range(widgets)
+    item = state.queue.add(url, page_start, page_end,
+                           destdir=widgets.destdir.get_text())
+    widgets.queue.get_model().append((item.get_name(), 0, item.state))
+    start_queue_item(widgets, state, item)
+
+
+def on_queue_pause__clicked(button, widgets, state):
+    item = get_selected_queue_item(state, widgets)
+    if not item:
+        return
+    entry = state.queue_entries.get(item)
+    entry_state = (entry.get_state() if entry else None)
+    if entry_state == "running":
+        entry.job.pause()
+        state.queue.update(item, state="paused")
+    elif entry_state == "paused":
+        entry.job.resume()
+        state.queue.update(item, state="running")
+    elif entry_state != "queued" and item.state != "finished":
+        # Paused before a restart, cancelled or failed: start it again
+        start_queue_item(widgets, state, item)
+    update_queue_row(widgets, state, item)
+
+
+def on_queue_cancel__clicked(button, widgets, state):
+    item = get_selected_queue_item(state, widgets)
+    if item:
+        cancel_queue_item(widgets, state, item)
+
+
+def on_queue_remove__clicked(button, widgets, state):
+    item = get_selected_queue_item(state, widgets)
+    if item:
+        cancel_queue_item(widgets, state, item)
+        index = state.queue.items.index(item)
+        state.queue.remove(item)
+        model = widgets.queue.get_model()
+        model.remove(model.get_iter((index,)))
+
+
+def on_queue_jobs__value_changed(spin, widgets, state):
+    state.scheduler.set_max_jobs(spin.get_value_as_int())
+
+
 def clean_exit(widgets, state):
     if state.download_job and state.download_job.is_alive():
         state.download_job.cancel()
+    # Books running are not marked as cancelled, they are queued again
+    # when the queue is loaded
+    for entry in state.queue_entries.values():
+        if entry.get_state() in ("running", "paused"):
+            entry.job.cancel()
+    widgets.thumbnail_view.stop()
     gtk.main_quit()
 
 
@@ -397,6 +881,11 @@ def set_callbacks(namespace, widgets, state):
         "pause": "clicked",
         "browse_destdir": "clicked",
         "savepdf": "clicked",
+        "queue_add": "clicked",
+        "queue_pause": "clicked",
+        "queue_cancel": "clicked",
+        "queue_remove": "clicked",
+        "queue_jobs": "value-changed",
     }
     for widget_name, signals in callbacks_mapping.iteritems():
         if isinstance(signals, str):
@@ -427,12 +916,16 @@ def load_glade(filename, root, widget_names):
     return lib.Struct(**dwidgets)
 
 
-def run(book_url=None):
+def run(book_url=None, store_directory=None, session_file=None,
+        nsessions=1, retries=1, retry_delay=0.0, queue_file=None,
+        queue_jobs=2, log_file=None, prefetch=True):
     widget_names = [
         "window", "url", "destdir", "check", "start", "cancel",
         "pause", "exit", "log", "page_start", "page_end",
         "title", "attribution", "npages", "browse_destdir",
         "progress_all", "progress_current", "savepdf",
+        "queue", "queue_add", "queue_pause", "queue_cancel", "queue_remove",
+        "queue_jobs", "thumbnails",
     ]
     currentdir = os.path.join(os.path.dirname(__file__))
     testpaths = [currentdir,
@@ -447,18 +940,99 @@ def run(book_url=None):
         raise ValueError('cannot find glade file: main.glade')
     widgets = load_glade(filepath, "window", widget_names)
     state = State()
-    widgets.debug = get_debug_func(widgets)
+    if store_directory:
+        from pysheng.store import ImageStore
+        state.image_store = ImageStore(store_directory)
+    if session_file:
+        state.session_store = sessions.SessionStore(session_file)
+    state.nsessions = nsessions
+    state.retries = retries
+    state.retry_delay = retry_delay
+    state.prefetch = prefetch
+    state.queue = bookqueue.BookQueue(queue_file)
+    # Each book of the queue downloads its pages in a single task, so only
+    # books are limited here. Connections are limited by throttle (see
+    # --max-per-host), counted per download across all the books.
+    state.scheduler = asyncjobs.Scheduler(max_jobs=queue_jobs)
+    widgets.debug = LogView(widgets.log, fileobj=(log_file and
+                                                  open(log_file, "a")))
+    widgets.progress = ProgressView(widgets)
+    widgets.thumbnail_view = ThumbnailView(widgets.thumbnails)
     widgets.window.set_title("PySheng v%s: Google Books downloader" %
                              pysheng.VERSION)
     view_init(widgets)
+    queue_view_init(widgets)
+    widgets.queue_jobs.set_value(queue_jobs)
     set_callbacks(globals(), widgets, state)
+    for item in state.queue.items:
+        widgets.queue.get_model().append((item.get_name(), 0, item.state))
+        update_queue_row(widgets, state, item)
+    for item in state.queue.get_queued():
+        start_queue_item(widgets, state, item)
     if book_url:
         widgets.url.set_text(book_url)
     return widgets, state
 
 
 def main(args):
-    widgets, state = run(args[0] if args else None)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store', dest='store_directory', default=None,
+                        help='Content-addressed store shared by all books '
+                             '(page files are hardlinked into it)')
+    parser.add_argument('--session', dest='session_file', default=None,
+                        help='Cookies file to reuse the session between '
+                             'runs (it can be shared by many processes)')
+    parser.add_argument('--sessions', dest='sessions', type=int, default=1,
+                        help='Number of cookie sessions to spread pages '
+                             'across (restricted pages are retried on '
+                             'the other sessions)')
+    parser.add_argument('--retries', dest='retries', type=int, default=1,
+                        help='Times restricted pages are retried at the '
+                             'end of the book with a fresh session')
+    parser.add_argument('--retry-delay', dest='retry_delay', type=float,
+                        default=0.0, help='Cool-down before retrying '
+                                          'restricted pages (seconds)')
+    parser.add_argument('--no-prefetch', dest='prefetch',
+                        action='store_false', default=True,
+                        help='Do not download the next page while the '
+                             'current one is being written')
+    parser.add_argument('--limit-rate', dest='limit_rate',
+                        type=throttle.parse_rate, default=None,
+                        help='Bandwidth limit for all downloads, in bytes '
+                             'per second (suffixes k and M allowed)')
+    parser.add_argument('--max-per-host', dest='max_per_host', type=int,
+                        default=None, help='Simultaneous connections '
+                                           'allowed to each host (shared '
+                                           'by all the books)')
+    parser.add_argument('--metrics-jsonl', dest='metrics_jsonl',
+                        default=None, help='Write timing events as JSON '
+                                           'lines to a file (- for stdout)')
+    parser.add_argument('--metrics-prometheus', dest='metrics_prometheus',
+                        default=None, help='Write summary counters to a '
+                                           'Prometheus text file')
+    parser.add_argument('--queue', dest='queue_file',
+                        default=QUEUE_FILE, help='File where the download '
+                                                 'queue is saved')
+    parser.add_argument('--queue-jobs', dest='queue_jobs', type=int,
+                        default=2, help='Books of the queue downloaded at '
+                                        'the same time')
+    parser.add_argument('--log-file', dest='log_file', default=None,
+                        help='Append the log to a file (the log view only '
+                             'shows the last %d lines)' % MAX_LOG_LINES)
+    parser.add_argument('url', nargs='?', default=None,
+                        help='GOOGLE_BOOK_OR_ID')
+    args = parser.parse_args(args)
+    pysheng.add_metrics_hooks(args.metrics_jsonl, args.metrics_prometheus)
+    throttle.configure(args.limit_rate, args.max_per_host)
+    widgets, state = run(args.url, store_directory=args.store_directory,
+                         session_file=args.session_file,
+                         nsessions=args.sessions, retries=args.retries,
+                         retry_delay=args.retry_delay,
+                         queue_file=args.queue_file,
+                         queue_jobs=args.queue_jobs,
+                         log_file=args.log_file,
+                         prefetch=args.prefetch)
     widgets.window.show_all()
     gtk.main()
 
@@ -15,13 +15,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this software.  If not, see <http://www.gnu.org/licenses/>
 
-import cookielib
-import urllib2
-import urllib
+# Network modules (urllib2, cookielib) are slow to import, so they are
+# imported by the functions that need them
+import contextlib
+import threading
 import errno
+import zlib
 import sys
 import os
 
+import throttle
+
+ACCEPT_ENCODING = "gzip, deflate"
+
 
 class Struct:
     """Struct/record-like class"""
@@ -53,31 +59,330 @@ def first(iterable, pred=bool):
             return item
 
 
-def download(url, opener=None, agent='Mozilla/5.0 (X11; U; Linux x86_64)'):
-    """Download a URL, optionally using a urlib2.opener"""
+def import_json():
+    """Import and return the JSON module (it's not needed on start-up)."""
+    try:
+        # Python >= 2.6
+        import json
+    except ImportError:
+        import simplejson as json
+    return json
+
+
+def open_url(url, opener=None, agent='Mozilla/5.0 (X11; U; Linux x86_64)',
+             accept_encoding=ACCEPT_ENCODING, headers=None, timeout=None):
+    """Open a URL, optionally using a urlib2.opener, and return the
+    response. With a timeout (seconds), blocking operations of the socket
+    (connect or read) fail after that time (see is_timeout)."""
+    import urllib2
     opener = opener or urllib2.build_opener()
     request = (url if isinstance(url, urllib2.Request) else build_request(url))
     if agent:
         request.add_header('User-Agent', agent)
-    return opener.open(request).read()
+    if accept_encoding:
+        request.add_header('Accept-Encoding', accept_encoding)
+    for key, value in (headers or {}).iteritems():
+        request.add_header(key, value)
+    if timeout:
+        return opener.open(request, timeout=timeout)
+    return opener.open(request)
+
+
+def is_timeout(exc):
+    """Return True if the exception of a download is a socket timeout."""
+    import socket
+    # urllib2.URLError wraps the timeouts of the connection
+    return isinstance(getattr(exc, "reason", exc), socket.timeout)
+
+
+def download(url, opener=None, **kwargs):
+    """Download a URL, optionally using a urlib2.opener. Compressed
+    responses (gzip or deflate) are decompressed. Limits set in module
+    throttle are applied."""
+    with throttle.hosts.connection(url):
+        return read_response(open_url(url, opener, **kwargs))
+
+
+def get_validators(response):
+    """Return a dictionary with the validators of a response (etag and
+    last_modified, if present)."""
+    headers = response.info()
+    validators = dict(etag=headers.get("ETag"),
+                      last_modified=headers.get("Last-Modified"))
+    return dict((k, v) for (k, v) in validators.iteritems() if v)
+
+
+def download_if_modified(url, validators=None, opener=None, **kwargs):
+    """
+    Download a URL with a conditional request, given the validators (see
+    get_validators) of a cached copy. Return (data, validators), data being
+    None if the server replies Not Modified (the cached copy is valid).
+    """
+    import urllib2
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    with throttle.hosts.connection(url):
+        try:
+            response = open_url(url, opener, headers=headers, **kwargs)
+        except urllib2.HTTPError, exc:
+            if exc.code == 304 and headers:
+                return None, validators
+            raise
+        return read_response(response), get_validators(response)
+
+
+# Responses being read, by owner thread, so they can be aborted (or paused)
+# from another one. Threads working for another one (see
+# set_download_owner) read responses on behalf of it.
+_responses = {}
+_paused = {}
+_responses_lock = threading.Lock()
+_owner = threading.local()
+
+
+class DownloadPaused(IOError):
+    """A download was interrupted by pause_downloads, download it again
+    after wait_while_paused."""
+
+
+def set_download_owner(thread_id):
+    """Make the downloads of the current thread those of another thread,
+    so they are aborted and paused with it."""
+    _owner.thread_id = thread_id
+
+
+def get_download_owner():
+    return (getattr(_owner, "thread_id", None) or
+            threading.current_thread().ident)
+
+
+def read_response(response, chunk_size=64*1024):
+    """Read the body of an urllib2 response, decompressing it while it's
+    read if it has a Content-Encoding. The read can be aborted or paused
+    from other threads (see abort_downloads and pause_downloads)."""
+    decompressor = Decompressor(response.info().get("Content-Encoding"))
+    chunks = []
+    owner = get_download_owner()
+    content_length = response.info().get("Content-Length")
+    response.size = (int(content_length) if content_length else None)
+    response.received = 0
+    with _responses_lock:
+        _responses.setdefault(owner, []).append(response)
+        paused = (owner in _paused)
+    if paused:
+        shutdown_response(response, "paused")
+    try:
+        while not getattr(response, "aborted", False):
+            try:
+                data = response.read(chunk_size)
+            except Exception:
+                # A read interrupted by shutdown_response can fail anyhow
+                if getattr(response, "aborted", False):
+                    break
+                raise
+            if not data:
+                break
+            response.received += len(data)
+            throttle.bandwidth.consume(len(data))
+            chunks.append(decompressor.decompress(data))
+        aborted = getattr(response, "aborted", False)
+        if aborted == "paused":
+            raise DownloadPaused("download paused: %s" % response.geturl())
+        elif aborted:
+            raise IOError("download aborted: %s" % response.geturl())
+    finally:
+        with _responses_lock:
+            _responses[owner].remove(response)
+            if not _responses[owner]:
+                del _responses[owner]
+    chunks.append(decompressor.flush())
+    return "".join(chunks)
+
+
+def get_downloads(thread_id):
+    """Return the responses being read by a thread (see read_response) as
+    dictionaries with the url, the bytes received and the size (None if
+    unknown)."""
+    with _responses_lock:
+        responses = list(_responses.get(thread_id, []))
+    return [dict(url=response.geturl(), received=response.received,
+                 size=response.size) for response in responses]
+
+
+def abort_downloads(thread_id):
+    """Abort the responses being read by a thread (see read_response). If
+    its downloads are paused, the waits for a resume are aborted too (see
+    wait_while_paused)."""
+    with _responses_lock:
+        responses = list(_responses.get(thread_id, []))
+        event = _paused.get(thread_id)
+        if event:
+            event.aborted = True
+    for response in responses:
+        shutdown_response(response)
+    if event:
+        event.set()
+
+
+def pause_downloads(thread_id):
+    """Interrupt the responses being read by a thread, and those it reads
+    until resume_downloads is called, with DownloadPaused."""
+    with _responses_lock:
+        _paused.setdefault(thread_id, threading.Event())
+        responses = list(_responses.get(thread_id, []))
+    for response in responses:
+        shutdown_response(response, "paused")
+
+
+def resume_downloads(thread_id):
+    with _responses_lock:
+        event = _paused.pop(thread_id, None)
+    if event:
+        event.set()
+
+
+def wait_while_paused():
+    """Block while the downloads of the current thread are paused. Raise
+    IOError if they are aborted meanwhile."""
+    with _responses_lock:
+        event = _paused.get(get_download_owner())
+    if event:
+        event.wait()
+        if getattr(event, "aborted", False):
+            raise IOError("download aborted while paused")
+
+
+def shutdown_response(response, reason=True):
+    """Shut down the socket of an urllib2 response, so a read blocked in
+    another thread returns at once, and close the response. The reason is
+    kept in response.aborted."""
+    import socket
+    response.aborted = reason
+    obj = response
+    # addinfourl -> socket._fileobject -> HTTPResponse -> ... -> socket
+    # (the last one is the C socket, not an instance of socket.socket)
+    for depth in range(8):
+        if hasattr(obj, "shutdown"):
+            try:
+                obj.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            break
+        obj = (getattr(obj, "_sock", None) or getattr(obj, "fp", None))
+        if obj is None:
+            break
+    try:
+        response.close()
+    except Exception:
+        pass
+
+
+class Decompressor:
+    """
+    Streaming decoder for a Content-Encoding: gzip, deflate (with or
+    without the zlib header, as servers send both) or identity (any other
+    encoding is returned as it is).
+    """
+    def __init__(self, content_encoding=None):
+        self.encoding = (content_encoding or "identity").strip().lower()
+        if self.encoding in ("gzip", "x-gzip"):
+            self._decompressobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._decompressobj = None
+
+    def decompress(self, data):
+        if self.encoding == "deflate" and not self._decompressobj:
+            try:
+                self._decompressobj = zlib.decompressobj()
+                return self._decompressobj.decompress(data)
+            except zlib.error:
+                self._decompressobj = zlib.decompressobj(-zlib.MAX_WBITS)
+        if self._decompressobj:
+            return self._decompressobj.decompress(data)
+        return data
+
+    def flush(self):
+        return (self._decompressobj.flush() if self._decompressobj else "")
 
 
 def build_request(url, postdata=None):
     """Build a URL request with (optional) POST data"""
+    import urllib
+    import urllib2
     data = (urllib.urlencode(postdata) if postdata else None)
     return urllib2.Request(url, data)
 
 
-def get_cookies_opener(filename=None):
-    """Open a cookies file and return a urllib2 opener object"""
-    cookie_jar = cookielib.FileCookieJar()
-    if filename:
-        cookie_jar.load(filename)
+def get_cookies_opener(filename=None, cookie_jar=None):
+    """Open a cookies file (or use a cookie jar) and return a urllib2
+    opener object"""
+    import cookielib
+    import urllib2
+    if cookie_jar is None:
+        cookie_jar = cookielib.LWPCookieJar()
+        if filename:
+            cookie_jar.load(filename, ignore_discard=True)
     opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cookie_jar))
     opener.cookie_jar = cookie_jar
     return opener
 
 
+IMAGE_SIGNATURES = [
+    ("\x89PNG\r\n\x1a\n", "png"),
+    ("\xff\xd8\xff", "jpeg"),
+    ("GIF87a", "gif"),
+    ("GIF89a", "gif"),
+    ("BM", "bmp"),
+    ("II*\x00", "tiff"),
+    ("MM\x00*", "tiff"),
+]
+
+IMAGE_CONTENT_TYPES = {
+    "image/png": "png",
+    "image/jpeg": "jpeg",
+    "image/jpg": "jpeg",
+    "image/pjpeg": "jpeg",
+    "image/gif": "gif",
+    "image/bmp": "bmp",
+    "image/tiff": "tiff",
+    "image/webp": "webp",
+}
+
+
+def get_image_format_from_header(header):
+    """Return image format from the first bytes of an image (or None)."""
+    for signature, image_format in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_format
+    if header[:4] == "RIFF" and header[8:12] == "WEBP":
+        return "webp"
+
+
+def get_image_format(data=None, content_type=None, default=None):
+    """
+    Return the image format (png, jpeg, ...) of data, a string or a seekable
+    stream, looking only at its first bytes. If the signature is unknown,
+    use the Content-Type header (if given) or return the default value.
+    """
+    image_format = None
+    if data is not None:
+        if hasattr(data, "read"):
+            position = data.tell()
+            header = data.read(16)
+            data.seek(position)
+        else:
+            header = data[:16]
+        image_format = get_image_format_from_header(header)
+    if not image_format and content_type:
+        mimetype = content_type.split(";")[0].strip().lower()
+        image_format = IMAGE_CONTENT_TYPES.get(mimetype)
+    return image_format or default
+
+
 def create_pdf_from_images(image_paths, output_pdf, pagesize=None,
                            margin=None):
     """Create a pdf from a sequence of images (one page per image)."""
@@ -103,3 +408,20 @@ def mkdir_p(path):
     except OSError as exc:
         if exc.errno != errno.EEXIST or not os.path.isdir(path):
             raise
+
+
+@contextlib.contextmanager
+def locked_file(path):
+    """Hold an exclusive lock (shared by processes) on path + '.lock'."""
+    lockfile = open(path + ".lock", "a")
+    try:
+        try:
+            import fcntl
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            import msvcrt
+            msvcrt.locking(lockfile.fileno(), msvcrt.LK_LOCK, 1)
+        yield
+    finally:
+        # Closing the file releases the lock
+        lockfile.close()
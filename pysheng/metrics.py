@@ -0,0 +1,235 @@
+#!/usr/bin/python
+"""
+Timing events for the download path.
+
+Code being measured calls emit() (or uses the timed() context manager),
+and every registered hook receives the event as a dictionary. Events:
+
+  * phase: a request or disk write (phase is cover, page_html, image or
+           write), with url, bytes, duration, error (if it failed) and
+           book_id (if known).
+  * page: a page was written (book_id, page, bytes).
+  * deferred: a page was restricted in all sessions and will be retried
+              at the end of the book (book_id, page, retry).
+  * restricted: a page could not be downloaded (book_id, page).
+  * book: a book was completed (status is done), cancelled or failed
+          (error), with the summary counters of the book.
+
+When no hooks are registered, emitting events costs almost nothing.
+"""
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import time
+import threading
+import contextlib
+import collections
+
+import lib
+import store
+
+hooks = []
+
+
+def add_hook(hook):
+    """Register a callable that will receive every event."""
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def emit(event, **fields):
+    """Send an event to all registered hooks."""
+    if not hooks:
+        return
+    fields.update(event=event, time=time.time())
+    for hook in list(hooks):
+        hook(fields)
+
+
+@contextlib.contextmanager
+def timed(phase, url=None, **fields):
+    """
+    Emit a phase event with the duration of the block. The block receives
+    a dictionary where it can set the number of bytes transferred:
+
+    with metrics.timed("image", url) as record:
+        record["bytes"] = len(download(url))
+    """
+    record = dict(bytes=None)
+    itime = time.time()
+    try:
+        yield record
+    except Exception, exc:
+        emit("phase", phase=phase, url=url, bytes=record["bytes"],
+             duration=time.time() - itime, error=str(exc), **fields)
+        raise
+    emit("phase", phase=phase, url=url, bytes=record["bytes"],
+         duration=time.time() - itime, **fields)
+
+
+@contextlib.contextmanager
+def book(book_id):
+    """Count the events of the book emitted in the block (events of other
+    books downloaded at the same time are not counted) and emit a book
+    event at the end."""
+    counters = Counters(book_id)
+    itime = time.time()
+    add_hook(counters)
+    status = "done"
+    try:
+        yield counters
+    except (GeneratorExit, KeyboardInterrupt):
+        status = "cancelled"
+        raise
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        remove_hook(counters)
+        emit("book", book_id=book_id, status=status,
+             duration=time.time() - itime, **counters.summary())
+
+
+class Counters:
+    """Hook that aggregates events (only those of book_id, if given) into
+    summary counters."""
+    def __init__(self, book_id=None):
+        self.book_id = book_id
+        self.phases = {}
+        self.pages = 0
+        self.page_bytes = 0
+        self.books = 0
+
+    def __call__(self, event):
+        if self.book_id and event.get("book_id") != self.book_id:
+            return
+        name = event["event"]
+        if name == "phase":
+            counters = self.phases.setdefault(event["phase"], dict(
+                requests=0, errors=0, bytes=0, duration=0.0))
+            counters["requests"] += 1
+            counters["errors"] += (1 if event.get("error") else 0)
+            counters["bytes"] += (event["bytes"] or 0)
+            counters["duration"] += event["duration"]
+        elif name == "page":
+            self.pages += 1
+            self.page_bytes += (event.get("bytes") or 0)
+        elif name == "book" and event.get("status", "done") == "done":
+            self.books += 1
+
+    def summary(self):
+        return dict(pages=self.pages, page_bytes=self.page_bytes,
+                    phases=dict((k, dict(v)) for (k, v) in
+                                self.phases.iteritems()))
+
+
+class Throughput:
+    """
+    Hook that measures the bytes downloaded and the pages written in the
+    last 'window' seconds (a moving average), only of book_id if given.
+    Events can be emitted by many threads. Older samples are dropped as
+    new ones arrive, so a hook that is never read does not grow.
+    """
+    def __init__(self, window=10.0, book_id=None):
+        self.window = window
+        self.book_id = book_id
+        self.start_time = time.time()
+        self.samples = collections.deque()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if self.book_id and event.get("book_id") != self.book_id:
+            return
+        name = event["event"]
+        if name == "phase" and event["phase"] != "write" and event["bytes"]:
+            sample = (event["time"], event["bytes"], 0)
+        elif name == "page":
+            sample = (event["time"], 0, 1)
+        else:
+            return
+        with self._lock:
+            self.samples.append(sample)
+            self._prune(sample[0])
+
+    def get_rates(self, now=None):
+        """Return (bytes per second, pages per minute)."""
+        now = (now or time.time())
+        with self._lock:
+            self._prune(now)
+            nbytes = sum(sample[1] for sample in self.samples)
+            npages = sum(sample[2] for sample in self.samples)
+        elapsed = max(min(self.window, now - self.start_time), 1.0)
+        return float(nbytes) / elapsed, 60.0 * npages / elapsed
+
+    def _prune(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+
+class JSONLinesHook:
+    """Write every event as a JSON line to a file object."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.json = lib.import_json()
+
+    def __call__(self, event):
+        self.fileobj.write(self.json.dumps(event) + "\n")
+        self.fileobj.flush()
+
+
+class PrometheusHook(Counters):
+    """Keep process-wide counters and write them in the Prometheus text
+    format (suitable for the node exporter textfile collector) every time
+    a book is completed."""
+    def __init__(self, path):
+        Counters.__init__(self)
+        self.path = path
+
+    def __call__(self, event):
+        Counters.__call__(self, event)
+        if event["event"] == "book":
+            self.write()
+
+    def get_text(self):
+        lines = []
+
+        def add(name, mtype, description, values):
+            lines.append("# HELP pysheng_%s %s" % (name, description))
+            lines.append("# TYPE pysheng_%s %s" % (name, mtype))
+            for labels, value in values:
+                lines.append("pysheng_%s%s %s" % (name, labels, value))
+        phases = sorted(self.phases.iteritems())
+        for key, mtype, description in [
+                ("requests", "counter", "Requests made, by phase"),
+                ("errors", "counter", "Failed requests, by phase"),
+                ("bytes", "counter", "Bytes transferred, by phase"),
+                ("duration", "counter", "Seconds spent, by phase")]:
+            name = ("phase_seconds_total" if key == "duration"
+                    else "phase_%s_total" % key)
+            add(name, mtype, description, [('{phase="%s"}' % phase,
+                                            counters[key])
+                                           for (phase, counters) in phases])
+        add("books_total", "counter", "Books completed", [("", self.books)])
+        add("pages_total", "counter", "Pages written", [("", self.pages)])
+        add("page_bytes_total", "counter", "Bytes of pages written",
+            [("", self.page_bytes)])
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        # Readable by the exporter, which usually runs as another user
+        store.write_atomic(self.path, self.get_text(), mode=0644)
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+"""
+Profile a run: cProfile statistics, wall-clock time spent in each phase of
+the download path (see metrics) and peak memory.
+
+with profiling.profile("pysheng.prof"):
+    ... download books ...
+"""
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import sys
+import time
+import contextlib
+
+import metrics
+
+PHASES = [
+    ("cover", "info fetch"),
+    ("page_html", "page HTML"),
+    ("image", "image fetch"),
+    ("write", "write"),
+]
+
+
+def get_peak_rss_kb():
+    """Return the peak resident memory of the process (KB), None if it's
+    not available (module resource is Unix-only)."""
+    try:
+        import resource
+    except ImportError:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, Mac OS X reports bytes
+    return (peak / 1024 if sys.platform == "darwin" else peak)
+
+
+def start_tracemalloc():
+    """Start tracing Python allocations, return the module (None if
+    tracemalloc is not available)."""
+    try:
+        import tracemalloc
+    except ImportError:
+        return
+    tracemalloc.start()
+    return tracemalloc
+
+
+def get_report(counters, elapsed, stats=None, peak_rss_kb=None,
+               peak_traced=None, nfunctions=20):
+    """Return the profile report (a string)."""
+    lines = ["%-12s %8s %6s %12s %9s %7s" % (
+        "Phase", "Requests", "Errors", "Bytes", "Seconds", "Wall")]
+    for phase, description in PHASES:
+        values = counters.phases.get(phase, dict(
+            requests=0, errors=0, bytes=0, duration=0.0))
+        lines.append("%-12s %8d %6d %12d %9.3f %6.1f%%" % (
+            description, values["requests"], values["errors"],
+            values["bytes"], values["duration"],
+            100.0 * values["duration"] / elapsed if elapsed else 0.0))
+    lines.append("Wall-clock time: %.3fs" % elapsed)
+    if peak_rss_kb is not None:
+        lines.append("Peak RSS: %d KB" % peak_rss_kb)
+    if peak_traced is not None:
+        lines.append("Peak traced memory (tracemalloc): %d KB" %
+                     (peak_traced / 1024))
+    if stats:
+        import StringIO
+        stream = StringIO.StringIO()
+        stats.stream = stream
+        stats.sort_stats("cumulative").print_stats(nfunctions)
+        lines.append(stream.getvalue().rstrip())
+    return "\n".join(lines) + "\n"
+
+
+@contextlib.contextmanager
+def profile(output_path, memory=False, stream=None):
+    """
+    Run the block with cProfile, save the statistics to output_path (read
+    them with pstats) and write a report to stream (default: stderr) with
+    the time spent in each phase, peak memory (if memory is set) and the
+    functions with the most cumulative time.
+    """
+    import cProfile
+    import pstats
+    stream = stream or sys.stderr
+    counters = metrics.Counters()
+    metrics.add_hook(counters)
+    tracemalloc = (start_tracemalloc() if memory else None)
+    profiler = cProfile.Profile()
+    itime = time.time()
+    profiler.enable()
+    try:
+        yield counters
+    finally:
+        profiler.disable()
+        elapsed = time.time() - itime
+        metrics.remove_hook(counters)
+        peak_traced = None
+        if tracemalloc:
+            peak_traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        profiler.dump_stats(output_path)
+        stats = pstats.Stats(output_path)
+        stream.write(get_report(
+            counters, elapsed, stats,
+            peak_rss_kb=(get_peak_rss_kb() if memory else None),
+            peak_traced=peak_traced))
+        stream.write("Profile saved to %s (python -m pstats %s)\n" %
+                     (output_path, output_path))
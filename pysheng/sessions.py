@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import threading
+
+import lib
+
+
+class SessionStore:
+    """
+    Cookies session saved to a file, so it can be reused by later runs and
+    by other processes (the file is locked when read or written).
+
+    store = SessionStore("~/.pysheng-cookies")
+    opener = store.get_opener()
+    ... use the opener for as many books as needed ...
+    store.save(opener)
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            lib.mkdir_p(directory)
+
+    def load(self):
+        """Return a cookie jar with the cookies saved in the store."""
+        import cookielib
+        cookie_jar = cookielib.LWPCookieJar()
+        with lib.locked_file(self.path):
+            self._load_into(cookie_jar)
+        return cookie_jar
+
+    def get_opener(self):
+        """Return an urllib2 opener that uses the stored cookies."""
+        return lib.get_cookies_opener(cookie_jar=self.load())
+
+    def save(self, opener_or_cookie_jar):
+        """
+        Save the cookies of an opener (or a cookie jar). Cookies saved by
+        other processes meanwhile are kept unless overwritten by ours.
+        """
+        import cookielib
+        cookie_jar = getattr(opener_or_cookie_jar, "cookie_jar",
+                             opener_or_cookie_jar)
+        with lib.locked_file(self.path):
+            stored_jar = cookielib.LWPCookieJar()
+            self._load_into(stored_jar)
+            for cookie in cookie_jar:
+                stored_jar.set_cookie(cookie)
+            stored_jar.save(self.path, ignore_discard=True)
+
+    def _load_into(self, cookie_jar):
+        import cookielib
+        if os.path.isfile(self.path):
+            try:
+                cookie_jar.load(self.path, ignore_discard=True)
+            except cookielib.LoadError:
+                # A corrupted file only means a cold session
+                pass
+
+
+class SessionPool:
+    """
+    Independent cookie sessions that share the download of a book. Pages
+    are spread across the active sessions, and a page restricted in a
+    session is requeued onto the next one. If another session serves the
+    page, the first one is retired (its quota is probably exhausted),
+    otherwise the restriction is specific to the page. The last active
+    session is never retired. A pool can be shared by threads.
+    """
+    def __init__(self, size=1, openers=None):
+        openers = list(openers or [])
+        while len(openers) < size:
+            openers.append(lib.get_cookies_opener())
+        self.active = openers
+        self.retired = []
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the next active opener (round-robin), None if none."""
+        with self._lock:
+            if not self.active:
+                return
+            self._index = self._index % len(self.active)
+            opener = self.active[self._index]
+            self._index += 1
+            return opener
+
+    def rotation(self):
+        """Yield active openers, starting with the next one in the
+        round-robin, until all of them have been yielded once. An opener
+        retired meanwhile is not yielded."""
+        start = self.get()
+        if start is None:
+            return
+        with self._lock:
+            index = (self.active.index(start) if start in self.active
+                     else 0)
+            openers = self.active[index:] + self.active[:index]
+        for opener in openers:
+            if opener in self.active:
+                yield opener
+
+    def add_session(self, opener=None):
+        """Add a session (by default, a fresh one) and return its opener."""
+        opener = opener or lib.get_cookies_opener()
+        with self._lock:
+            self.active.append(opener)
+        return opener
+
+    def retire(self, opener):
+        """Retire an active opener, unless it's the last one. Return True
+        if it was retired."""
+        with self._lock:
+            if opener in self.active and len(self.active) > 1:
+                self.active.remove(opener)
+                self.retired.append(opener)
+                return True
+        return False
+
+    def reset(self):
+        """Make all sessions active again (i.e. for a new book)."""
+        with self._lock:
+            self.active.extend(self.retired)
+            del self.retired[:]
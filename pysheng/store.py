@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+
+import lib
+
+
+def get_digest(data):
+    """Return the hex digest used to address data in the store."""
+    return hashlib.sha1(data).hexdigest()
+
+
+class ImageStore:
+    """
+    Content-addressed image store shared by many books.
+
+    Images are saved once under objects/ keyed by their digest, and the pages
+    of a book are hardlinks (copies when hardlinks are not supported) to
+    these objects. The store also keeps an index from page keys (see
+    download.get_store_key) to digests, so a known page can be written
+    without downloading it again.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects_directory = os.path.join(directory, "objects")
+        self.keys_directory = os.path.join(directory, "keys")
+        lib.mkdir_p(self.objects_directory)
+        lib.mkdir_p(self.keys_directory)
+
+    def get_path(self, digest):
+        return os.path.join(self.objects_directory, digest[:2], digest[2:])
+
+    def contains(self, digest):
+        return os.path.isfile(self.get_path(digest))
+
+    def put(self, data):
+        """Add data to the store (if not there yet) and return its digest."""
+        digest = get_digest(data)
+        path = self.get_path(digest)
+        if not os.path.isfile(path):
+            self._write_atomic(path, data)
+        return digest
+
+    def read(self, digest):
+        return open(self.get_path(digest), "rb").read()
+
+    def set_key(self, key, digest):
+        self._write_atomic(self._get_key_path(key), digest)
+
+    def get_key(self, key):
+        """Return the digest for key, None if unknown or missing in store."""
+        path = self._get_key_path(key)
+        if not os.path.isfile(path):
+            return
+        digest = open(path).read().strip()
+        if self.contains(digest):
+            return digest
+
+    def link(self, digest, output_path):
+        """Make output_path point to the object digest."""
+        path = self.get_path(digest)
+        if os.path.lexists(output_path):
+            os.remove(output_path)
+        try:
+            os.link(path, output_path)
+        except (OSError, AttributeError):
+            shutil.copyfile(path, output_path)
+
+    def write(self, output_path, data, key=None):
+        """Put data in the store and link it to output_path."""
+        digest = self.put(data)
+        if key:
+            self.set_key(key, digest)
+        self.link(digest, output_path)
+        return digest
+
+    def _get_key_path(self, key):
+        return os.path.join(self.keys_directory, get_digest(lib.tostr(key)))
+
+    def _write_atomic(self, path, data):
+        write_atomic(path, data)
+
+
+class InfoCache:
+    """
+    Book information (see download.get_info) saved as a JSON file for each
+    book, so it does not have to be downloaded again. Entries older than
+    max_age seconds (if given) are stale: they keep the validators of the
+    cover (see lib.get_validators), so they can be revalidated.
+    """
+    def __init__(self, directory, max_age=None):
+        self.directory = directory
+        self.max_age = max_age
+        lib.mkdir_p(directory)
+
+    def get_path(self, book_id):
+        return os.path.join(self.directory,
+                            get_digest(lib.tostr(book_id)) + ".json")
+
+    def get(self, book_id):
+        """Return the information of a book, None if not cached (or
+        stale)."""
+        entry = self.get_entry(book_id)
+        if entry and not entry["stale"]:
+            return entry["info"]
+
+    def get_entry(self, book_id):
+        """Return the entry of a book (a dictionary with info, validators
+        and stale), None if not cached."""
+        json = lib.import_json()
+        path = self.get_path(book_id)
+        if not os.path.isfile(path):
+            return
+        try:
+            entry = json.loads(open(path).read())
+        except ValueError:
+            entry = None
+        if not isinstance(entry, dict) or "info" not in entry:
+            # A corrupted entry is just a cache miss
+            return
+        age = time.time() - os.path.getmtime(path)
+        entry["stale"] = (self.max_age is not None and age > self.max_age)
+        entry.setdefault("validators", {})
+        return entry
+
+    def put(self, book_id, info, validators=None):
+        json = lib.import_json()
+        write_atomic(self.get_path(book_id), json.dumps(dict(
+            book_id=book_id, info=info, validators=(validators or {}))))
+
+    def touch(self, book_id):
+        """Mark the entry of a book as fresh (i.e. it was revalidated)."""
+        os.utime(self.get_path(book_id), None)
+
+
+def write_atomic(path, data, mode=None):
+    """Write data to path (creating its directory), so readers never see
+    a partial file. The file is only readable by the user unless a mode is
+    given."""
+    directory = os.path.dirname(path)
+    lib.mkdir_p(directory)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, "wb") as fileobj:
+            fileobj.write(data)
+            fileobj.flush()
+            os.fsync(fileobj.fileno())
+        os.rename(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
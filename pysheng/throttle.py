@@ -0,0 +1,119 @@
+#!/usr/bin/python
+"""
+Bandwidth and connection limits shared by all the downloads of the process.
+
+lib.download and asyncjobs.ProgressDownloadThreadedTask open connections
+within hosts.connection(url) and call bandwidth.consume() for every chunk
+they read, so limits set with configure() apply to all of them.
+"""
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import re
+import time
+import threading
+import contextlib
+
+
+class TokenBucket:
+    """
+    Token bucket shared by threads: consume() blocks until the bytes fit in
+    the rate (bytes/second, None for no limit), allowing bursts of up to
+    burst bytes (by default, one second at the rate).
+    """
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def configure(self, rate=None, burst=None):
+        with self._lock:
+            self.rate = rate
+            self.burst = (burst or rate)
+            self.tokens = self.burst
+            self.timestamp = time.time()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            # Tokens may go negative, later callers wait for the debt too
+            self.tokens -= nbytes
+            wait = (-self.tokens / float(self.rate) if self.tokens < 0 else 0)
+        if wait:
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """Limit the number of simultaneous connections to each host."""
+    def __init__(self, limit=None):
+        self._lock = threading.Lock()
+        self.configure(limit)
+
+    def configure(self, limit=None):
+        with self._lock:
+            self.limit = limit
+            self._semaphores = {}
+
+    @contextlib.contextmanager
+    def connection(self, url):
+        """Hold a connection slot for the host of url (a string or an
+        urllib2.Request) while the block runs."""
+        if not self.limit:
+            yield
+            return
+        host = get_host(url)
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if not semaphore:
+                semaphore = threading.BoundedSemaphore(self.limit)
+                self._semaphores[host] = semaphore
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+def get_host(url):
+    """Return the host (with port) of a URL or urllib2.Request."""
+    if hasattr(url, "get_full_url"):
+        url = url.get_full_url()
+    match = re.match(r"[\w.+-]+://([^/?#]*)", url)
+    return (match.group(1).lower() if match else "")
+
+
+def parse_rate(value):
+    """Parse a rate in bytes (i.e. 500000, 500k, 1.5M), return an int."""
+    match = re.match(r"^\s*([\d.]+)\s*([kKmMgG]?)\s*$", value)
+    if not match:
+        raise ValueError("invalid rate: %s" % value)
+    number, unit = match.groups()
+    multiplier = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    return int(float(number) * multiplier[unit.lower()])
+
+
+bandwidth = TokenBucket()
+hosts = HostLimiter()
+
+
+def configure(rate=None, per_host=None):
+    """Set the bandwidth limit (bytes/second) and the connections allowed
+    for each host. None means no limit."""
+    bandwidth.configure(rate)
+    hosts.configure(per_host)
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+"""
+Thumbnails of the downloaded pages (used by the GUI).
+
+Images are decoded by a background thread (ThumbnailLoader) only when
+requested, and the thumbnails are kept in a bounded cache (LRUCache), so
+showing a book of many pages does not decode or keep all of them.
+"""
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import threading
+import collections
+
+
+class LRUCache:
+    """
+    Dictionary of at most maxsize items. When it's full, adding an item
+    removes the least recently used one (evict_cb(key, value) is called).
+    """
+    def __init__(self, maxsize, evict_cb=None):
+        self.maxsize = maxsize
+        self.evict_cb = evict_cb
+        self.items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.maxsize:
+            old_key, old_value = self.items.popitem(last=False)
+            if self.evict_cb:
+                self.evict_cb(old_key, old_value)
+
+    def clear(self):
+        self.items.clear()
+
+
+class ThumbnailLoader:
+    """
+    Decode images in a background thread. request(keys) replaces the keys
+    waiting to be decoded (usually, the pages that are visible now), and
+    for every key decoded the thread calls loaded_cb(key, decode(key)).
+    The value is None if decode raises an exception.
+    """
+    def __init__(self, decode, loaded_cb):
+        self.decode = decode
+        self.loaded_cb = loaded_cb
+        self.pending = []
+        self.stopped = False
+        self._condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def request(self, keys):
+        with self._condition:
+            self.pending = list(keys)
+            self._condition.notify()
+
+    def stop(self):
+        with self._condition:
+            self.stopped = True
+            self.pending = []
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.pending and not self.stopped:
+                    self._condition.wait()
+                if self.stopped:
+                    return
+                key = self.pending.pop(0)
+            try:
+                value = self.decode(key)
+            except Exception:
+                value = None
+            self.loaded_cb(key, value)
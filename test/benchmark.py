@@ -0,0 +1,248 @@
+#!/usr/bin/python
+"""
+Benchmark pysheng downloads against a local mock Google Books server.
+
+Each scenario runs in its own process (so peak RSS is not shared) and
+reports pages/sec, p50/p99 page latency and peak RSS:
+
+  $ python test/benchmark.py --pages 50 --latency 0.02
+  $ python test/benchmark.py --scenario cli --bandwidth 200000 --json
+
+Option --import-time measures instead the start-up time of the interpreter
+importing pysheng modules (compared to an empty interpreter):
+
+  $ python test/benchmark.py --import-time
+"""
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+sys.path.insert(0, TESTS_DIR)
+
+import mockserver
+
+SCENARIOS = ["generator", "cli", "asyncjobs"]
+IMPORT_STATEMENTS = [
+    "pass",
+    "import pysheng",
+    "from pysheng import asyncjobs",
+]
+BOOK_ID = "mockbook"
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def get_download_module(url):
+    """Return module pysheng.download (shadowed by function download) with
+    the mock server URL set."""
+    import pysheng
+    download = sys.modules["pysheng.download"]
+    download.BOOKS_URL = url + "/books"
+    return download
+
+
+def run_generator(url, options):
+    """Iterate download.download_book, the core of the CLI."""
+    download = get_download_module(url)
+    latencies = []
+    itime = time.time()
+    for info, page, image_data in download.download_book(BOOK_ID):
+        now = time.time()
+        latencies.append(now - itime)
+        itime = now
+    return latencies
+
+
+def run_cli(url, options):
+    """Run download.main, writing the images to a temporal directory."""
+    download = get_download_module(url)
+    output_directory = tempfile.mkdtemp()
+    try:
+        download.main(["-q", "-o", output_directory, BOOK_ID])
+        npages = len(os.listdir(output_directory))
+    finally:
+        shutil.rmtree(output_directory)
+    return [None] * npages
+
+
+def run_asyncjobs(url, options):
+    """Download the pages using asyncjobs tasks, as the GUI does."""
+    from pysheng import asyncjobs, lib
+    download = get_download_module(url)
+    headers = {"User-Agent": download.AGENT}
+    latencies = []
+
+    def job():
+        opener = lib.get_cookies_opener()
+        cover_url = download.get_cover_url(BOOK_ID)
+        html = yield asyncjobs.ProgressDownloadThreadedTask(
+            cover_url, opener, headers=headers)
+        info = download.get_info(html)
+        for page_id in info["page_ids"]:
+            itime = time.time()
+            page_url = download.get_page_url(info["prefix"], page_id)
+            page_html = yield asyncjobs.ProgressDownloadThreadedTask(
+                page_url, opener, headers=headers)
+            image_url = download.get_image_url_from_page(page_html)
+            if image_url:
+                yield asyncjobs.ProgressDownloadThreadedTask(
+                    image_url, opener, headers=headers, accept_encoding=None)
+                latencies.append(time.time() - itime)
+    asyncjobs.Job(job()).join(looptime=0.001)
+    return latencies
+
+
+def run_scenario(name, url, options):
+    """Run a scenario in this process and return a dictionary of results."""
+    from pysheng.profiling import get_peak_rss_kb
+    function = globals()["run_" + name]
+    itime = time.time()
+    latencies = function(url, options)
+    elapsed = time.time() - itime
+    page_latencies = [x for x in latencies if x is not None]
+    return dict(
+        scenario=name,
+        pages=len(latencies),
+        elapsed=elapsed,
+        pages_per_second=(len(latencies) / elapsed if elapsed else None),
+        p50=percentile(page_latencies, 0.50),
+        p99=percentile(page_latencies, 0.99),
+        peak_rss_kb=get_peak_rss_kb(),
+    )
+
+
+def spawn_scenario(name, url, options):
+    """Run a scenario in a child process and return its results."""
+    command = [sys.executable, os.path.abspath(__file__),
+               "--child", name, "--url", url]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output, _ = process.communicate()
+    if process.returncode:
+        return dict(scenario=name, error="exit code %d" % process.returncode)
+    return json.loads(output)
+
+
+def run_import_time(repeat):
+    """Return a dictionary for each import statement with the median time
+    (in seconds) of a new interpreter running it."""
+    root_directory = os.path.dirname(TESTS_DIR)
+    results = []
+    for statement in IMPORT_STATEMENTS:
+        times = []
+        for index in range(repeat):
+            itime = time.time()
+            subprocess.check_call([sys.executable, "-c", statement],
+                                  cwd=root_directory)
+            times.append(time.time() - itime)
+        results.append(dict(statement=statement,
+                            median=percentile(times, 0.5),
+                            best=min(times)))
+    return results
+
+
+def format_result(result):
+    if "error" in result:
+        return "%(scenario)-10s error: %(error)s" % result
+
+    def ms(value):
+        return ("%.1fms" % (1000 * value) if value is not None else "-")
+    return ("%-10s %4d pages in %6.2fs  %7.2f pages/s  p50=%s  p99=%s  "
+            "peak_rss=%dKB" % (result["scenario"], result["pages"],
+                               result["elapsed"], result["pages_per_second"],
+                               ms(result["p50"]), ms(result["p99"]),
+                               result["peak_rss_kb"]))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scenario', dest='scenarios', action='append',
+                        choices=SCENARIOS, help='Scenario to run '
+                        '(can be repeated, default: all)')
+    parser.add_argument('--pages', type=int, default=20,
+                        help='Number of pages of the book')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Latency for each response (seconds)')
+    parser.add_argument('--bandwidth', type=int, default=None,
+                        help='Bandwidth for each response (bytes/second)')
+    parser.add_argument('--error-rate', dest='error_rate', type=float,
+                        default=0.0, help='Fraction of responses that fail')
+    parser.add_argument('--image-size', dest='image_size', type=int,
+                        default=None, help='Size of images (bytes)')
+    parser.add_argument('--json', action="store_true", default=False,
+                        help='Output results as JSON lines')
+    parser.add_argument('--import-time', dest='import_time',
+                        action="store_true", default=False,
+                        help='Measure import (start-up) time instead')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='Runs for each import statement')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+
+    if options.child:
+        try:
+            result = run_scenario(options.child, options.url, options)
+        except ImportError, exc:
+            result = dict(scenario=options.child, error=str(exc))
+        sys.stdout.write(json.dumps(result) + "\n")
+        return
+
+    if options.import_time:
+        results = run_import_time(options.repeat)
+        baseline = results[0]["median"]
+        for result in results:
+            result["overhead"] = result["median"] - baseline
+            if options.json:
+                print json.dumps(result)
+            else:
+                print "%-32s median=%.1fms  best=%.1fms  overhead=%.1fms" % (
+                    result["statement"], 1000 * result["median"],
+                    1000 * result["best"], 1000 * result["overhead"])
+        return
+
+    config = mockserver.Config(
+        npages=options.pages, latency=options.latency,
+        bandwidth=options.bandwidth, error_rate=options.error_rate,
+        image_size=options.image_size, seed=0)
+    server = mockserver.MockServer(config).start()
+    try:
+        for name in (options.scenarios or SCENARIOS):
+            result = spawn_scenario(name, server.url, options)
+            if options.json:
+                print json.dumps(result)
+            else:
+                print format_result(result)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+"""
+Local HTTP server that mimics Google Books for tests and benchmarks.
+
+Covers, pages and images are built from the fixtures in test/html, with
+a configurable number of pages, latency, bandwidth, error rate, fraction
+of restricted pages (or page ids always restricted) and pages allowed for
+each cookie session. Images can also be requested directly (without the
+signature of the page HTML), unless direct_images is disabled. HTML
+responses are compressed with gzip when the client accepts it (unless
+compress is disabled), and covers have validators (ETag and
+Last-Modified) for conditional requests. Responses can stall halfway
+(stall seconds) to test timeouts, only the first ones if stalls is set.
+"""
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import os
+import re
+import json
+import time
+import gzip
+import hashlib
+import random
+import StringIO
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
+HTML_DIR = os.path.join(TESTS_DIR, "html")
+
+RESTRICTED_HTML = '<img src="/googlebooks/restricted_logo.gif">'
+LAST_MODIFIED = "Sat, 01 Jan 2011 00:00:00 GMT"
+
+
+def read_fixture(name):
+    return open(os.path.join(HTML_DIR, name), "rb").read()
+
+
+def get_page_ids(npages):
+    return ["PA%d" % page for page in range(1, npages + 1)]
+
+
+def build_cover_html(base_url, book_id, npages):
+    """Return the fixture cover with npages pages and a local prefix."""
+    html = read_fixture("cover.html")
+    match = re.search(r'_OC_Run\((.*?)\);', html)
+    args = json.loads("[%s]" % match.group(1), encoding="iso8859-1")
+    args[0]["prefix"] = "%s/books?id=%s&lpg=PP1&ie=ISO-8859-1" % \
+        (base_url, book_id)
+    args[0]["page"] = [dict(pid=page_id, order=order) for (order, page_id)
+                       in enumerate(get_page_ids(npages))]
+    oc_run = "_OC_Run(%s);" % json.dumps(args)[1:-1]
+    return html[:match.start()] + oc_run + html[match.end():]
+
+
+def build_page_html(base_url, book_id, page_id):
+    """Return the fixture page pointing to a local image."""
+    html = read_fixture("page.html")
+    image_url = "%s/books?id=%s&pg=%s&img=1&zoom=3&hl=es&sig=MOCK&w=685" % \
+        (base_url, book_id, page_id)
+    return re.sub(r"(preloadImg.src = ')[^']*(')",
+                  lambda match: match.group(1) + image_url + match.group(2),
+                  html)
+
+
+def gzip_data(data):
+    fileobj = StringIO.StringIO()
+    gzip_file = gzip.GzipFile(fileobj=fileobj, mode="wb")
+    gzip_file.write(data)
+    gzip_file.close()
+    return fileobj.getvalue()
+
+
+class Config:
+    """Server behaviour, can be changed while the server is running."""
+    def __init__(self, npages=10, latency=0.0, bandwidth=None,
+                 error_rate=0.0, restricted_rate=0.0, image_size=None,
+                 session_quota=None, direct_images=True, compress=True,
+                 stall=0.0, stalls=None, restricted_pages=None, seed=None):
+        self.npages = npages
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.restricted_rate = restricted_rate
+        self.image_size = image_size
+        self.session_quota = session_quota
+        self.direct_images = direct_images
+        self.compress = compress
+        self.stall = stall
+        self.stalls = stalls
+        self.restricted_pages = set(restricted_pages or [])
+        self.random = random.Random(seed)
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        server.count_request(self.path,
+                             self.headers.get("Accept-Encoding"))
+        if config.latency:
+            time.sleep(config.latency)
+        if config.error_rate and config.random.random() < config.error_rate:
+            return self.send_error(500, "Mock error")
+        self.session = self.get_session()
+        self.new_session = not self.session
+        if self.new_session:
+            self.session = server.new_session()
+        path, _, query = self.path.partition("?")
+        params = dict(urlparse.parse_qsl(query))
+        book_id = params.get("id", "mockbook")
+        if path != "/books":
+            self.send_error(404)
+        elif "img" in params and "sig" in params:
+            self.reply(server.get_image(), "image/png")
+        elif "img" in params and not config.direct_images:
+            self.send_error(404)
+        elif "pg" in params:
+            if self.is_restricted(params["pg"]):
+                html = RESTRICTED_HTML
+            elif "img" in params:
+                return self.reply(server.get_image(), "image/png")
+            else:
+                html = build_page_html(server.url, book_id, params["pg"])
+            self.reply(html, "text/html; charset=ISO-8859-1")
+        elif params.get("printsec") == "frontcover":
+            html = build_cover_html(server.url, book_id, config.npages)
+            etag = '"%s"' % hashlib.sha1(html).hexdigest()
+            if self.headers.get("If-None-Match") == etag or \
+                    self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                self.send_response(304)
+                self.end_headers()
+            else:
+                self.reply(html, "text/html; charset=ISO-8859-1",
+                           headers={"ETag": etag,
+                                    "Last-Modified": LAST_MODIFIED})
+        else:
+            self.send_error(404)
+
+    def is_restricted(self, page_id):
+        """Count a page for the session and return if it's restricted."""
+        config = self.server.config
+        restricted = (page_id in config.restricted_pages or
+                      (config.restricted_rate and
+                       config.random.random() < config.restricted_rate))
+        pages = self.server.count_session_page(self.session)
+        return bool(restricted or (config.session_quota and
+                                   pages > config.session_quota))
+
+    def get_session(self):
+        """Return the session cookie of the request (None if new)."""
+        match = re.search(r"\bNID=(\w+)", self.headers.get("Cookie", ""))
+        if match and match.group(1) in self.server.sessions:
+            return match.group(1)
+
+    def reply(self, data, content_type, headers=None):
+        self.send_response(200)
+        for key, value in (headers or {}).iteritems():
+            self.send_header(key, value)
+        if self.new_session:
+            self.send_header("Set-Cookie", "NID=%s; path=/; expires=%s" %
+                             (self.session, "Fri, 01-Jan-2038 00:00:00 GMT"))
+        self.send_header("Content-Type", content_type)
+        if (self.server.config.compress and content_type.startswith("text/")
+                and "gzip" in self.headers.get("Accept-Encoding", "")):
+            data = gzip_data(data)
+            self.send_header("Content-Encoding", "gzip")
+        self.server.count_bytes(len(data))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        bandwidth = self.server.config.bandwidth
+        chunk_size = (max(1, int(bandwidth / 20)) if bandwidth else len(data))
+        stall_at = (len(data) // 2 if self.server.count_stall() else None)
+        for index in range(0, len(data), chunk_size):
+            chunk = data[index:index+chunk_size]
+            if stall_at is not None and index + len(chunk) > stall_at:
+                self.wfile.write(chunk[:stall_at - index])
+                self.wfile.flush()
+                time.sleep(self.server.config.stall)
+                chunk, stall_at = chunk[stall_at - index:], None
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(float(len(chunk)) / bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded mock server, use start() and stop()."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), MockHandler)
+        self.config = config or Config()
+        self.url = "http://%s:%d" % self.server_address
+        self.requests = []
+        self.accept_encodings = []
+        self.sessions = []
+        self.session_pages = {}
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._image = None
+
+    def count_request(self, path, accept_encoding=None):
+        with self._lock:
+            self.requests.append(path)
+            self.accept_encodings.append(accept_encoding)
+
+    def count_bytes(self, nbytes):
+        with self._lock:
+            self.bytes_sent += nbytes
+
+    def count_stall(self):
+        """Return if the response must stall (and count it)."""
+        config = self.config
+        with self._lock:
+            if not config.stall or config.stalls == 0:
+                return False
+            if config.stalls is not None:
+                config.stalls -= 1
+            return True
+
+    def new_session(self):
+        with self._lock:
+            session = "session%d" % (len(self.sessions) + 1)
+            self.sessions.append(session)
+        return session
+
+    def count_session_page(self, session):
+        """Count a page request for a session and return its total."""
+        with self._lock:
+            self.session_pages[session] = \
+                self.session_pages.get(session, 0) + 1
+            return self.session_pages[session]
+
+    def get_image(self):
+        if self._image is None:
+            image = read_fixture("image.png")
+            size = self.config.image_size
+            if size and size > len(image):
+                # Trailing bytes after IEND are ignored by image readers
+                image += "\0" * (size - len(image))
+            self._image = image
+        return self._image
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
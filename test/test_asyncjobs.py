@@ -21,8 +21,12 @@ import time
 import gobject
 import functools
 
+import pysheng
+
 from pysheng import asyncjobs
+from pysheng import throttle
 from pysheng.yieldfrom import supergenerator, _from
+import mockserver
 
 
 TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
@@ -173,6 +177,205 @@ class TestAsyncJobs(unittest.TestCase):
         self.tick_events()
         self.assertEqual("bye", self.state.job_result2)
 
+# Immediate task
+
+
+def immediate_job(state, ntasks):
+    state.results = []
+    for index in range(ntasks):
+        result = yield asyncjobs.ImmediateTask(index)
+        state.results.append(result)
+    try:
+        yield asyncjobs.ImmediateTask(exception=ValueError())
+    except ValueError, exc:
+        state.job_result = exc
+
+
+class TestImmediateTask(unittest.TestCase):
+    def setUp(self):
+        self.loop = gobject.MainLoop()
+        self.context = self.loop.get_context()
+        self.state = State()
+        self.ntasks = 2 * asyncjobs.MAX_IMMEDIATE_STEPS + 10
+        self.job = asyncjobs.Job(immediate_job(self.state, self.ntasks))
+
+    def test_results_are_sent_without_main_loop_round_trips(self):
+        self.context.iteration(False)
+        self.assertEqual(range(asyncjobs.MAX_IMMEDIATE_STEPS),
+                         self.state.results)
+        self.assertTrue(self.job.is_alive())
+
+    def test_task(self):
+        self.job.join()
+        self.assertEqual(range(self.ntasks), self.state.results)
+        self.assertEqual(ValueError, type(self.state.job_result))
+        self.assertFalse(self.job.is_alive())
+
+# Threaded generator task
+
+
+def counter(state, n):
+    for index in range(n):
+        state.generated.append(index)
+        yield index
+    if state.exception:
+        raise state.exception
+
+
+def threaded_generator_job(state, n, buffer_size):
+    try:
+        state.job_result = yield asyncjobs.ThreadedGeneratorTask(
+            counter(state, n), item_cb=state.values.append,
+            buffer_size=buffer_size)
+    except Exception, exc:
+        state.job_result = exc
+
+
+class TestThreadedGeneratorTask(unittest.TestCase):
+    def setUp(self):
+        self.loop = gobject.MainLoop()
+        self.context = self.loop.get_context()
+        self.state = State()
+        self.state.generated = []
+        self.state.values = []
+        self.state.exception = None
+
+    def start(self, n, buffer_size=1):
+        self.job = asyncjobs.Job(threaded_generator_job(self.state, n,
+                                                        buffer_size))
+        self.context.iteration(False)
+
+    def test_task(self):
+        self.start(10)
+        self.job.join()
+        self.assertEqual(range(10), self.state.values)
+        self.assertEqual(10, self.state.job_result)
+
+    def test_exception(self):
+        self.state.exception = ValueError()
+        self.start(3)
+        self.job.join()
+        self.assertEqual(range(3), self.state.values)
+        self.assertEqual(ValueError, type(self.state.job_result))
+
+    def test_backpressure(self):
+        self.start(100, buffer_size=2)
+        time.sleep(0.3)
+        # The value being put in the full queue has been generated too
+        self.assertEqual(3, len(self.state.generated))
+        self.job.join()
+        self.assertEqual(range(100), self.state.values)
+
+    def test_pause_and_resume(self):
+        self.start(100)
+        self.job.pause()
+        time.sleep(0.3)
+        ngenerated = len(self.state.generated)
+        time.sleep(0.3)
+        self.context.iteration(False)
+        self.assertEqual(ngenerated, len(self.state.generated))
+        self.assertEqual([], self.state.values)
+        self.job.resume()
+        self.job.join()
+        self.assertEqual(range(100), self.state.values)
+
+    def test_cancel(self):
+        self.start(100)
+        task = self.job.current_task
+        self.job.cancel()
+        task.thread.join(1.0)
+        self.assertFalse(task.thread.isAlive())
+        self.assertTrue(len(self.state.generated) < 100)
+
+# Scheduler
+
+
+class SlotTask(TestTask):
+    uses_slot = True
+
+
+def slot_job(state, name, ntasks):
+    for index in range(ntasks):
+        task = SlotTask()
+        state.tasks.append((name, task))
+        yield task
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.loop = gobject.MainLoop()
+        self.context = self.loop.get_context()
+        self.state = State()
+        self.state.tasks = []
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def tick_events(self):
+        for index in range(5):
+            self.context.iteration(False)
+
+    def get_running_tasks(self):
+        return [(name, task) for (name, task) in self.state.tasks
+                if hasattr(task, "return_cb") and not task.done]
+
+    def finish_tasks(self):
+        for name, task in self.get_running_tasks():
+            task.do_action(action="return")
+        self.tick_events()
+
+    def add(self, name, ntasks=2, priority=0):
+        return self.scheduler.add(slot_job(self.state, name, ntasks),
+                                  priority=priority, name=name)
+
+    def test_max_jobs_and_priorities(self):
+        self.scheduler = asyncjobs.Scheduler(max_jobs=1)
+        entry1 = self.add("job1")
+        entry2 = self.add("job2")
+        entry3 = self.add("job3", priority=1)
+        self.assertEqual(["running", "queued", "queued"],
+                         [entry.get_state() for entry in
+                          (entry1, entry2, entry3)])
+        self.tick_events()
+        self.finish_tasks()
+        self.finish_tasks()
+        self.assertEqual("finished", entry1.get_state())
+        self.assertEqual("running", entry3.get_state())
+        self.assertEqual("queued", entry2.get_state())
+
+    def test_max_tasks_are_shared_fairly(self):
+        self.scheduler = asyncjobs.Scheduler(max_tasks=1)
+        self.add("job1", ntasks=3)
+        self.add("job2", ntasks=3)
+        self.tick_events()
+        names = []
+        while self.get_running_tasks():
+            running = self.get_running_tasks()
+            self.assertEqual(1, len(running))
+            names.append(running[0][0])
+            self.finish_tasks()
+        self.assertEqual(["job1", "job2"] * 3, names)
+        self.assertEqual(0, self.scheduler.tasks)
+
+    def test_pause_and_resume_all(self):
+        self.scheduler = asyncjobs.Scheduler(max_jobs=1, max_tasks=1)
+        entry1 = self.add("job1")
+        entry2 = self.add("job2")
+        self.tick_events()
+        self.scheduler.pause_all()
+        self.assertEqual("paused", entry1.get_state())
+        self.assertEqual("paused", self.state.tasks[0][1].state)
+        self.scheduler.resume_all()
+        self.assertEqual("running", self.state.tasks[0][1].state)
+        self.scheduler.cancel(entry1)
+        self.tick_events()
+        self.assertEqual("cancelled", entry1.get_state())
+        self.assertEqual("running", entry2.get_state())
+        self.assertEqual(1, self.scheduler.tasks)
+        self.scheduler.cancel(entry2)
+        self.assertEqual(0, self.scheduler.tasks)
+        self.assertFalse(self.scheduler.is_alive())
+
 # Threaded task
 
 
@@ -253,5 +456,159 @@ class TestThreadedTask(unittest.TestCase):
         self.assertEqual(len(data), elapsed_total)
 
 
+# Timeouts
+
+
+class ProgressTask(TestTask):
+    """Task that progresses (but never finishes) while self.progress."""
+    def __init__(self):
+        TestTask.__init__(self)
+        self.progress = True
+        self.counter = 0
+
+    def get_progress(self):
+        if self.progress:
+            self.counter += 1
+        return self.counter
+
+
+def timeout_job(state, task):
+    try:
+        state.job_result = yield task
+    except Exception, exc:
+        state.job_result = exc
+
+
+class TestTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.state = State()
+
+    def test_timeout(self):
+        task = ProgressTask().set_timeouts(timeout=0.3)
+        job = asyncjobs.Job(timeout_job(self.state, task))
+        job.join()
+        self.assertTrue(isinstance(self.state.job_result,
+                                   asyncjobs.TaskError))
+        self.assertEqual("cancelled", task.state)
+
+    def test_stall_timeout(self):
+        task = ProgressTask().set_timeouts(stall_timeout=0.3)
+        job = asyncjobs.Job(timeout_job(self.state, task))
+        loop = gobject.MainLoop()
+        itime = time.time()
+        while time.time() - itime < 1.0:
+            loop.get_context().iteration(False)
+            time.sleep(0.01)
+        self.assertTrue(job.is_alive())
+        task.progress = False
+        job.join()
+        self.assertTrue("stalled" in str(self.state.job_result))
+
+    def test_finished_task_is_not_aborted(self):
+        task = TestTask().set_timeouts(timeout=0.3)
+        job = asyncjobs.Job(timeout_job(self.state, task))
+        gobject.MainLoop().get_context().iteration(False)
+        task.do_action(action="return", value="hello")
+        job.join()
+        time.sleep(0.5)
+        gobject.MainLoop().get_context().iteration(False)
+        self.assertEqual("hello", self.state.job_result)
+        self.assertEqual("running", task.state)
+
+
+class TestStalledDownload(unittest.TestCase):
+    def setUp(self):
+        self.config = mockserver.Config(image_size=64*1024, stall=5.0,
+                                        stalls=1)
+        self.server = mockserver.MockServer(self.config).start()
+        self.url = self.server.url + "/books?id=mockbook&pg=PA1&img=1&sig=1"
+        self.state = State()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_reconnect(self):
+        task = asyncjobs.ProgressDownloadThreadedTask(self.url, reconnects=1)
+        job = asyncjobs.Job(timeout_job(self.state,
+                                        task.set_timeouts(stall_timeout=0.5)))
+        job.join()
+        self.assertEqual(self.server.get_image(), self.state.job_result)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_abort(self):
+        task = asyncjobs.ProgressDownloadThreadedTask(self.url)
+        job = asyncjobs.Job(timeout_job(self.state,
+                                        task.set_timeouts(stall_timeout=0.5)))
+        itime = time.time()
+        job.join()
+        self.assertTrue(time.time() - itime < 4.0)
+        self.assertTrue(isinstance(self.state.job_result,
+                                   asyncjobs.TaskError))
+
+
+class TestPausedDownload(unittest.TestCase):
+    def setUp(self):
+        self.config = mockserver.Config(image_size=64*1024,
+                                        bandwidth=64*1024)
+        self.server = mockserver.MockServer(self.config).start()
+        self.url = self.server.url + "/books?id=mockbook&pg=PA1&img=1&sig=1"
+        throttle.configure(per_host=1)
+
+    def tearDown(self):
+        throttle.configure()
+        self.server.stop()
+
+    def test_paused_download_releases_the_host(self):
+        state1, state2 = State(), State()
+        task = asyncjobs.ProgressDownloadThreadedTask(self.url)
+        job1 = asyncjobs.Job(timeout_job(state1, task))
+        context = gobject.MainLoop().get_context()
+        while not getattr(task, "current_size", 0):
+            context.iteration(False)
+            time.sleep(0.01)
+        job1.pause()
+        job2 = asyncjobs.Job(timeout_job(
+            state2, asyncjobs.ProgressDownloadThreadedTask(self.url)))
+        job2.join(looptime=0.01)
+        self.assertEqual(self.server.get_image(), state2.job_result)
+        job1.resume()
+        job1.join(looptime=0.01)
+        self.assertEqual(self.server.get_image(), state1.job_result)
+
+    def test_pause_interrupts_the_downloads_of_a_generator(self):
+        def fetch_images():
+            yield pysheng.fetch("image", self.url)
+        state = State()
+        task = asyncjobs.ThreadedGeneratorTask(fetch_images())
+        job = asyncjobs.Job(timeout_job(state, task))
+        context = gobject.MainLoop().get_context()
+        while not task.get_downloads():
+            context.iteration(False)
+            time.sleep(0.01)
+        job.pause()
+        time.sleep(0.2)
+        self.assertEqual([], task.get_downloads())
+        job.resume()
+        job.join(looptime=0.01)
+        self.assertEqual(1, state.job_result)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_cancel_a_paused_generator(self):
+        def fetch_images():
+            yield pysheng.fetch("image", self.url)
+        task = asyncjobs.ThreadedGeneratorTask(fetch_images())
+        job = asyncjobs.Job(timeout_job(State(), task))
+        context = gobject.MainLoop().get_context()
+        while not task.get_downloads():
+            context.iteration(False)
+            time.sleep(0.01)
+        job.pause()
+        time.sleep(0.2)
+        job.cancel()
+        task.thread.join(1.0)
+        self.assertFalse(task.thread.isAlive())
+        self.assertEqual(1, len(self.server.requests))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from pysheng import bookqueue
+
+
+class TestBookQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "queue.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_queue_survives_a_restart(self):
+        queue = bookqueue.BookQueue(self.path)
+        item1 = queue.add("book1", 0, 9, destdir="/books")
+        item2 = queue.add("book2")
+        item3 = queue.add("book3")
+        queue.update(item1, state="running", title="Book 1", npages=10,
+                     pages=4)
+        queue.update(item2, state="paused")
+        queue.remove(item3)
+
+        queue = bookqueue.BookQueue(self.path)
+        item1, item2 = queue.items
+        self.assertEqual(("book1", 0, 9, "/books"),
+                         (item1.url, item1.page_start, item1.page_end,
+                          item1.destdir))
+        self.assertEqual("Book 1", item1.get_name())
+        self.assertEqual(0.4, item1.get_progress())
+        # Interrupted books are queued again
+        self.assertEqual([item1], queue.get_queued())
+        self.assertEqual("paused", item2.state)
+
+    def test_update_without_saving(self):
+        queue = bookqueue.BookQueue(self.path)
+        item = queue.add("book1")
+        queue.update(item, save=False, npages=10, pages=4)
+        self.assertEqual(None, bookqueue.BookQueue(self.path).items[0].npages)
+        queue.update(item, state="paused")
+        item, = bookqueue.BookQueue(self.path).items
+        self.assertEqual((10, 4, "paused"),
+                         (item.npages, item.pages, item.state))
+
+    def test_unknown_field(self):
+        queue = bookqueue.BookQueue()
+        item = queue.add("book1")
+        self.assertRaises(ValueError, queue.update, item, color="red")
+
+    def test_corrupted_file(self):
+        open(self.path, "w").write("[{")
+        self.assertEqual([], bookqueue.BookQueue(self.path).items)
+
+
+if __name__ == '__main__':
+    unittest.main()
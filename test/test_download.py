@@ -1,8 +1,14 @@
 #!/usr/bin/python
 import unittest
+import tempfile
+import StringIO
+import shutil
+import json
+import sys
 import os
 
 import pysheng
+import mockserver
 
 TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
 HTML_DIR = os.path.join(TESTS_DIR, "html")
@@ -30,6 +36,12 @@ class TestLibrary(unittest.TestCase):
         self.assertEqual("Artistic Theory in Italy", info["title"])
         self.assertEqual("Anthony Blunt", info["attribution"])
 
+    def test_get_direct_image_url(self):
+        prefix = 'http://books.google.com/books?id=2TowtKyI27wC&lpg=PP1'
+        self.assertEqual('http://books.google.com/books?id=2TowtKyI27wC&'
+                         'lpg=PP1&pg=PA3&img=1&zoom=3&w=800',
+                         pysheng.get_direct_image_url(prefix, "PA3", 800))
+
     def test_get_image_url_from_page(self):
         htmlpage = open(os.path.join(HTML_DIR, "page.html")).read()
         image_url = pysheng.get_image_url_from_page(htmlpage)
@@ -39,5 +51,247 @@ class TestLibrary(unittest.TestCase):
                          image_url)
 
 
+class TestDownloadBook(unittest.TestCase):
+    def setUp(self):
+        self.download = sys.modules["pysheng.download"]
+        self.books_url = self.download.BOOKS_URL
+        self.config = mockserver.Config(npages=5)
+        self.server = mockserver.MockServer(self.config).start()
+        self.download.BOOKS_URL = self.server.url + "/books"
+
+    def tearDown(self):
+        self.download.BOOKS_URL = self.books_url
+        self.server.stop()
+
+    def test_download_book(self):
+        pages = list(pysheng.download_book("mockbook", 1, 4))
+        self.assertEqual([1, 2, 3], [page for (info, page, data) in pages])
+        info, page, image_data = pages[0]
+        self.assertEqual(5, len(info["page_ids"]))
+        self.assertEqual("png", pysheng.lib.get_image_format(image_data))
+
+    def test_download_book_without_prefetch(self):
+        pages = list(pysheng.download_book("mockbook", prefetch=0))
+        self.assertEqual(range(5), [page for (info, page, data) in pages])
+        self.assertEqual(5, len(self.get_page_requests()))
+
+    def test_stalled_page_is_downloaded_again(self):
+        info = pysheng.get_info_from_url("mockbook")
+        self.config.stall, self.config.stalls = 5.0, 1
+        timeout, self.download.TIMEOUT = self.download.TIMEOUT, 0.5
+        try:
+            pages = list(pysheng.download_book("mockbook", info=info))
+        finally:
+            self.download.TIMEOUT = timeout
+        self.assertEqual(range(5), [page for (info, page, data) in pages])
+        self.assertEqual(6, len(self.get_page_requests()))
+
+    def test_skip_pages(self):
+        pages = list(pysheng.download_book("mockbook", skip_pages=set([0, 3])))
+        self.assertEqual([1, 2, 4], [page for (info, page, data) in pages])
+        self.assertEqual(3, len(self.get_page_requests()))
+
+    def test_html_is_transferred_compressed(self):
+        info = pysheng.get_info_from_url("mockbook")
+        self.assertEqual(5, len(info["page_ids"]))
+        compressed_bytes = self.server.bytes_sent
+        self.config.compress = False
+        pysheng.get_info_from_url("mockbook")
+        self.assertTrue(compressed_bytes <
+                        (self.server.bytes_sent - compressed_bytes) / 2)
+
+    def test_images_are_not_requested_compressed(self):
+        list(pysheng.download_book("mockbook", 0, 2))
+        self.config.direct_images = False
+        list(pysheng.download_book("mockbook", 2, 4))
+        for path, accept_encoding in zip(self.server.requests,
+                                         self.server.accept_encodings):
+            # httplib sends "identity" when no encoding is given
+            self.assertEqual("img=1" not in path,
+                             "gzip" in (accept_encoding or ""))
+
+    def get_page_requests(self):
+        return [path for path in self.server.requests if "pg=" in path]
+
+    def test_images_are_requested_directly(self):
+        pages = list(pysheng.download_book("mockbook"))
+        self.assertEqual(5, len(pages))
+        requests = self.get_page_requests()
+        self.assertEqual(5, len(requests))
+        self.assertTrue(all("img=1" in path for path in requests))
+
+    def test_page_html_is_used_when_direct_images_fail(self):
+        self.config.direct_images = False
+        pages = list(pysheng.download_book("mockbook"))
+        self.assertEqual(5, len(pages))
+        for info, page, image_data in pages:
+            self.assertEqual("png", pysheng.lib.get_image_format(image_data))
+        # Only the first page tries the direct request
+        self.assertEqual(1 + 5 * 2, len(self.get_page_requests()))
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.download = sys.modules["pysheng.download"]
+        self.books_url = self.download.BOOKS_URL
+        self.config = mockserver.Config(npages=5)
+        self.server = mockserver.MockServer(self.config).start()
+        self.download.BOOKS_URL = self.server.url + "/books"
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.download.BOOKS_URL = self.books_url
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_resolve_book(self):
+        records = list(self.download.resolve_book("mockbook", 1, 4))
+        self.assertEqual([2, 3, 4], [record["page"] for record in records])
+        self.assertEqual(["PA2", "PA3", "PA4"],
+                         [record["page_id"] for record in records])
+        for record in records:
+            self.assertFalse(record["restricted"])
+            self.assertTrue("sig=MOCK" in record["image_url"])
+        self.assertFalse([path for path in self.server.requests
+                          if "img=1" in path])
+
+    def test_restricted_pages_have_no_image_url(self):
+        self.config.session_quota = 2
+        records = list(self.download.resolve_book("mockbook"))
+        restricted = [record for record in records if record["restricted"]]
+        # Pages are resolved in parallel, so any of them can be restricted
+        self.assertEqual(3, len(restricted))
+        self.assertEqual([None] * 3,
+                         [record["image_url"] for record in restricted])
+
+    def test_resolve_and_import(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.download.main(["--resolve-only", "-e", "3", "mockbook"])
+            manifest = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        manifest_path = os.path.join(self.directory, "manifest.jsonl")
+        open(manifest_path, "w").write(manifest)
+        for line in manifest.splitlines():
+            record = json.loads(line)
+            # Fetch the images as a bulk fetcher would (but page 2)
+            if record["page"] != 2:
+                path = os.path.join(self.directory, record["book_id"],
+                                    record["page_id"])
+                pysheng.lib.mkdir_p(os.path.dirname(path))
+                data = pysheng.lib.download(record["image_url"])
+                open(path, "wb").write(data)
+        output_directory = os.path.join(self.directory, "books")
+        self.download.main(["-q", "--import", manifest_path,
+                            "-o", output_directory])
+        book_directory, = os.listdir(output_directory)
+        self.assertEqual(["001.png", "003.png"], sorted(os.listdir(
+            os.path.join(output_directory, book_directory))))
+
+    def test_resolve_keeps_going_past_failures(self):
+        get_image_url = self.download.get_image_url
+
+        def get_image_url_stub(info, page_id, *args, **kwargs):
+            if page_id == "PA2":
+                raise IOError("Connection reset")
+            return get_image_url(info, page_id, *args, **kwargs)
+        self.download.get_image_url = get_image_url_stub
+        try:
+            records = list(self.download.resolve_book("mockbook"))
+        finally:
+            self.download.get_image_url = get_image_url
+        self.assertEqual(range(1, 6), [record["page"] for record in records])
+        self.assertEqual("Connection reset", records[1]["error"])
+        self.assertEqual((None, False), (records[1]["image_url"],
+                                         records[1]["restricted"]))
+        self.assertEqual([1, 3, 4, 5], [record["page"] for record in records
+                                        if record["image_url"]])
+
+    def test_import_skips_records_without_image_url(self):
+        manifest_path = os.path.join(self.directory, "manifest.jsonl")
+        records = [dict(book_id="mockbook", page=1, page_id="PA1",
+                        image_url=None, error="Connection reset"),
+                   dict(book_id="mockbook", page=2, page_id="PA2")]
+        open(manifest_path, "w").write(
+            "".join(json.dumps(record) + "\n" for record in records))
+        args = pysheng.lib.Struct(quiet=True, noredownload=False)
+        missing = self.download.import_manifest(manifest_path, args,
+                                                self.directory)
+        self.assertEqual(records, missing)
+
+
+class TestMetadata(unittest.TestCase):
+    def setUp(self):
+        self.download = sys.modules["pysheng.download"]
+        self.books_url = self.download.BOOKS_URL
+        self.server = mockserver.MockServer(mockserver.Config(npages=5))
+        self.server.start()
+        self.download.BOOKS_URL = self.server.url + "/books"
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.download.BOOKS_URL = self.books_url
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def get_metadata(self, args):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            status = self.download.main(["--metadata-only"] + args)
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        return status, [json.loads(line) for line in output.splitlines()]
+
+    def test_metadata_keeps_going_past_failures(self):
+        status, records = self.get_metadata(
+            ["book1", "http://books.google.com/books?noid", "book2"])
+        self.assertEqual(1, status)
+        self.assertEqual(["book1", None, "book2"],
+                         [record.get("book_id") for record in records])
+        self.assertEqual(5, records[0]["pages"])
+        self.assertEqual("Artistic Theory in Italy", records[0]["title"])
+        self.assertTrue("error" in records[1])
+
+    def test_metadata_uses_the_info_cache(self):
+        urls_file = os.path.join(self.directory, "urls.txt")
+        open(urls_file, "w").write("book1\nbook2\n")
+        args = ["--info-cache", os.path.join(self.directory, "info"),
+                "--urls-file", urls_file]
+        status, records = self.get_metadata(args)
+        self.assertEqual(0, status)
+        self.assertEqual(2, len(self.server.requests))
+        status, cached_records = self.get_metadata(args)
+        self.assertEqual(records, cached_records)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_stale_info_is_revalidated(self):
+        cache = pysheng.store.InfoCache(os.path.join(self.directory, "info"))
+        info = pysheng.get_info_from_url("book1", info_cache=cache)
+        validators = cache.get_entry("book1")["validators"]
+        self.assertTrue(validators["etag"])
+        self.assertTrue(validators["last_modified"])
+        bytes_sent = self.server.bytes_sent
+        cache.max_age = -1
+        self.assertEqual(None, cache.get("book1"))
+        cached_info = pysheng.get_info_from_url("book1", info_cache=cache)
+        self.assertEqual(info["page_ids"], cached_info["page_ids"])
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual(bytes_sent, self.server.bytes_sent)
+
+    def test_download_if_modified(self):
+        url = pysheng.get_cover_url("book1")
+        data, validators = pysheng.lib.download_if_modified(url)
+        self.assertTrue(data)
+        self.assertEqual((None, validators),
+                         pysheng.lib.download_if_modified(url, validators))
+        data2, validators2 = pysheng.lib.download_if_modified(
+            url, dict(etag='"other"'))
+        self.assertEqual(data, data2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,16 @@
 #!/usr/bin/python
 import unittest
+import tempfile
+import shutil
+import sys
 import gtk
 import time
 import os
 
 import pysheng
 from pysheng import gui
+from pysheng import asyncjobs
+from pysheng.yieldfrom import supergenerator, _from
 
 TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
 HTML_DIR = os.path.join(TESTS_DIR, "html")
@@ -26,7 +31,6 @@ class PyshengGUITest(unittest.TestCase):
             info = get_info_original(html)
             info["page_ids"] = info["page_ids"][:3]
             return info
-        pysheng.get_info = get_info_stub
 
         def get_cover_url_stub(book_id):
             return "file://" + os.path.join(HTML_DIR, "cover.html")
@@ -36,13 +40,22 @@ class PyshengGUITest(unittest.TestCase):
 
         def get_image_url_from_page_stub(page_html):
             return "file://" + os.path.join(HTML_DIR, "image.png")
-        pysheng.get_cover_url = get_cover_url_stub
-        pysheng.get_page_url = get_page_url_stub
-        pysheng.get_image_url_from_page = get_image_url_from_page_stub
 
-        def createfile_stub(path, data):
-            pass
-        gui.createfile = createfile_stub
+        def get_direct_image_stub(info, page_id, opener=None, book_id=None):
+            return None
+
+        def write_page_stub(output_directory, book_id, page, page_id,
+                            image_data, args, image_store=None):
+            return os.path.join(output_directory, "%03d.png" % (page + 1))
+        # The pages are downloaded by functions of the download module
+        # (see gui.download_pages), stub them there too
+        for module in (pysheng, sys.modules["pysheng.download"]):
+            module.get_info = get_info_stub
+            module.get_cover_url = get_cover_url_stub
+            module.get_page_url = get_page_url_stub
+            module.get_image_url_from_page = get_image_url_from_page_stub
+            module.get_direct_image = get_direct_image_stub
+            module.write_page = write_page_stub
 
     def complete_job(self, name0):
         name = name0 + "_job"
@@ -132,6 +145,66 @@ class PyshengGUITest(unittest.TestCase):
         self.widgets.start.clicked()
         self.complete_job("download")
 
+    def test_queue_process(self):
+        self.widgets.url.set_text("abookid")
+        self.widgets.queue_add.clicked()
+        self.widgets.url.set_text("anotherbookid")
+        self.widgets.queue_add.clicked()
+        self.assertEqual(2, len(self.widgets.queue.get_model()))
+        while self.state.scheduler.is_alive():
+            refresh_gui(0.1)
+        for item in self.state.queue.items:
+            self.assertEqual("finished", item.state)
+            self.assertEqual(3, item.pages)
+        row = self.widgets.queue.get_model()[0]
+        self.assertEqual(("Artistic Theory in Italy", 100, "finished"),
+                         tuple(row))
+
+    def test_existing_pages_are_not_downloaded(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for page in [0, 2]:
+                path = os.path.join(directory, "%03d.png" % (page + 1))
+                open(path, "wb").close()
+            pages, state = [], pysheng.lib.Struct()
+
+            @supergenerator
+            def job():
+                state.existing = yield _from(gui.get_existing_pages(
+                    0, 3, directory, pages.append))
+            asyncjobs.Job(job()).join(looptime=0.01)
+            self.assertEqual(set([0, 2]), state.existing)
+            self.assertEqual([0, 2], [page for (page, path) in pages])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_log_is_bounded(self):
+        buf = self.widgets.log.get_buffer()
+        refresh_gui()
+        buf.set_text("")
+        for index in range(gui.MAX_LOG_LINES + 10):
+            self.widgets.debug("line %d" % index)
+        self.assertEqual(1, buf.get_line_count())
+        refresh_gui()
+        self.assertEqual(gui.MAX_LOG_LINES + 1, buf.get_line_count())
+        text = buf.get_text(buf.get_start_iter(), buf.get_end_iter())
+        self.assertTrue(text.splitlines()[-1].endswith(
+            "line %d" % (gui.MAX_LOG_LINES + 9)))
+
+    def test_progress_is_coalesced(self):
+        progress = self.widgets.progress
+        for pages in range(1, 51):
+            progress.set_pages(pages, 100)
+        self.assertEqual("", self.widgets.progress_all.get_text())
+        refresh_gui(gui.PROGRESS_INTERVAL / 1000.0)
+        refresh_gui()
+        self.assertEqual("Total: 50%", self.widgets.progress_all.get_text())
+        progress.set_done("Done")
+        refresh_gui(gui.PROGRESS_INTERVAL / 1000.0)
+        refresh_gui()
+        self.assertEqual("Done", self.widgets.progress_all.get_text())
+        self.assertEqual(None, progress.source_id)
+
 
 if __name__ == '__main__':
     unittest.main()
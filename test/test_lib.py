@@ -17,9 +17,17 @@
 
 import unittest
 import tempfile
+import threading
+import urllib2
+import socket
+import time
+import zlib
 import os
 
 from pysheng import lib
+import mockserver
+
+TESTS_DIR = os.path.abspath(os.path.dirname(__file__))
 
 
 class TestLibrary(unittest.TestCase):
@@ -42,6 +50,126 @@ class TestLibrary(unittest.TestCase):
         path = self.create_temporal(data)
         self.assertEqual(lib.download("file://%s" % path), data)
 
+    def test_decompressor(self):
+        data = "<html>" + "page " * 1000 + "</html>"
+
+        def decompress(encoding, compressed_data, chunk_size=100):
+            decompressor = lib.Decompressor(encoding)
+            chunks = [decompressor.decompress(compressed_data[i:i+chunk_size])
+                      for i in range(0, len(compressed_data), chunk_size)]
+            return "".join(chunks) + decompressor.flush()
+        gzip_compressor = zlib.compressobj(9, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+        gzip_data = gzip_compressor.compress(data) + gzip_compressor.flush()
+        raw_compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        raw_data = raw_compressor.compress(data) + raw_compressor.flush()
+        self.assertEqual(data, decompress("gzip", gzip_data))
+        self.assertEqual(data, decompress("deflate", zlib.compress(data)))
+        self.assertEqual(data, decompress("deflate", raw_data))
+        self.assertEqual(data, decompress(None, data))
+        self.assertEqual(data, decompress("identity", data))
+
+    def test_abort_downloads(self):
+        config = mockserver.Config(image_size=100000, bandwidth=10000)
+        server = mockserver.MockServer(config).start()
+        url = server.url + "/books?id=book&pg=PA1&img=1&sig=MOCK"
+        result = {}
+
+        def download():
+            try:
+                result["data"] = lib.download(url)
+            except Exception, exc:
+                result["exception"] = exc
+        try:
+            thread = threading.Thread(target=download)
+            thread.start()
+            time.sleep(0.3)
+            itime = time.time()
+            lib.abort_downloads(thread.ident)
+            thread.join(5.0)
+            self.assertFalse(thread.isAlive())
+            self.assertTrue(time.time() - itime < 1.0)
+            self.assertTrue("exception" in result)
+        finally:
+            server.stop()
+
+    def test_pause_downloads(self):
+        config = mockserver.Config(image_size=100000, bandwidth=10000)
+        server = mockserver.MockServer(config).start()
+        url = server.url + "/books?id=book&pg=PA1&img=1&sig=MOCK"
+        result = {}
+
+        def download():
+            try:
+                lib.download(url)
+            except lib.DownloadPaused:
+                result["paused"] = time.time()
+            lib.wait_while_paused()
+            result["resumed"] = time.time()
+        try:
+            thread = threading.Thread(target=download)
+            thread.start()
+            time.sleep(0.3)
+            downloads = lib.get_downloads(thread.ident)
+            self.assertEqual(1, len(downloads))
+            self.assertEqual(url, downloads[0]["url"])
+            self.assertTrue(downloads[0]["received"] < downloads[0]["size"])
+            itime = time.time()
+            lib.pause_downloads(thread.ident)
+            time.sleep(0.3)
+            self.assertTrue(result["paused"] - itime < 0.2)
+            self.assertFalse("resumed" in result)
+            lib.resume_downloads(thread.ident)
+            thread.join(5.0)
+            self.assertFalse(thread.isAlive())
+            self.assertEqual([], lib.get_downloads(thread.ident))
+        finally:
+            server.stop()
+
+    def test_abort_paused_downloads(self):
+        owner = threading.current_thread().ident
+        result = {}
+
+        def wait():
+            lib.set_download_owner(owner)
+            try:
+                lib.wait_while_paused()
+            except IOError, exc:
+                result["exception"] = exc
+        lib.pause_downloads(owner)
+        try:
+            thread = threading.Thread(target=wait)
+            thread.start()
+            time.sleep(0.1)
+            lib.abort_downloads(owner)
+            lib.resume_downloads(owner)
+            thread.join(1.0)
+            self.assertFalse(thread.isAlive())
+            self.assertTrue("exception" in result)
+        finally:
+            lib.resume_downloads(owner)
+
+    def test_is_timeout(self):
+        self.assertTrue(lib.is_timeout(socket.timeout()))
+        self.assertTrue(lib.is_timeout(urllib2.URLError(socket.timeout())))
+        self.assertFalse(lib.is_timeout(IOError("download aborted")))
+
+    def test_shutdown_response_unblocks_read(self):
+        config = mockserver.Config(image_size=100000, stall=5.0)
+        server = mockserver.MockServer(config).start()
+        url = server.url + "/books?id=book&pg=PA1&img=1&sig=MOCK"
+        response = lib.open_url(url)
+        thread = threading.Thread(target=response.read)
+        try:
+            thread.start()
+            time.sleep(0.3)
+            itime = time.time()
+            lib.shutdown_response(response)
+            thread.join(5.0)
+            self.assertTrue(time.time() - itime < 1.0)
+        finally:
+            server.stop()
+
     def test_build_request(self):
         host = "exampleserver.org"
         url = "http://%s/1/2/file.html" % host
@@ -52,6 +180,28 @@ class TestLibrary(unittest.TestCase):
         build = lambda d: "&".join("%s=%s" % pair for pair in d.iteritems())
         self.assertEqual(request.get_data(), build(postdata))
 
+    def test_get_image_format(self):
+        png_path = os.path.join(TESTS_DIR, "html", "image.png")
+        png_data = open(png_path, "rb").read()
+        self.assertEqual("png", lib.get_image_format(png_data))
+        self.assertEqual("jpeg", lib.get_image_format("\xff\xd8\xff\xe0JFIF"))
+        self.assertEqual("gif", lib.get_image_format("GIF89a..."))
+        self.assertEqual("webp", lib.get_image_format("RIFF\0\0\0\0WEBPVP8 "))
+        self.assertEqual(None, lib.get_image_format("<html>"))
+        self.assertEqual("png", lib.get_image_format("<html>", default="png"))
+
+    def test_get_image_format_from_stream(self):
+        stream = open(os.path.join(TESTS_DIR, "html", "image.png"), "rb")
+        self.assertEqual("png", lib.get_image_format(stream))
+        self.assertEqual(0, stream.tell())
+
+    def test_get_image_format_from_content_type(self):
+        get = lib.get_image_format
+        self.assertEqual("jpeg", get(content_type="image/jpeg"))
+        self.assertEqual("gif", get("", content_type="image/GIF; q=1"))
+        self.assertEqual("png", get("\x89PNG\r\n\x1a\n", "image/jpeg"))
+        self.assertEqual(None, get(content_type="text/html"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import tempfile
+import StringIO
+import json
+import time
+import os
+
+from pysheng import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        metrics.add_hook(self.events.append)
+
+    def tearDown(self):
+        del metrics.hooks[:]
+
+    def test_timed(self):
+        with metrics.timed("image", "http://server/image") as record:
+            record["bytes"] = 10
+        event, = self.events
+        self.assertEqual("phase", event["event"])
+        self.assertEqual("image", event["phase"])
+        self.assertEqual(10, event["bytes"])
+        self.assertTrue(event["duration"] >= 0)
+        self.assertFalse("error" in event)
+
+    def test_timed_with_exception(self):
+        def _fail():
+            with metrics.timed("page_html", "http://server/page"):
+                raise IOError("timeout")
+        self.assertRaises(IOError, _fail)
+        self.assertEqual("timeout", self.events[0]["error"])
+
+    def test_book_summary(self):
+        with metrics.book("book1"):
+            with metrics.timed("image", book_id="book1") as record:
+                record["bytes"] = 100
+            metrics.emit("page", book_id="book1", page=1, bytes=100)
+            # Events of other books are not counted
+            with metrics.timed("image", book_id="book2") as record:
+                record["bytes"] = 50
+            metrics.emit("page", book_id="book2", page=1, bytes=50)
+        event = self.events[-1]
+        self.assertEqual("book", event["event"])
+        self.assertEqual("done", event["status"])
+        self.assertEqual(1, event["pages"])
+        self.assertEqual(100, event["phases"]["image"]["bytes"])
+        self.assertEqual([self.events.append], metrics.hooks)
+
+    def test_book_status(self):
+        def _fail():
+            with metrics.book("book1"):
+                raise IOError("timeout")
+        self.assertRaises(IOError, _fail)
+        self.assertEqual("error", self.events[-1]["status"])
+
+        def _download():
+            with metrics.book("book1"):
+                yield 1
+        generator = _download()
+        generator.next()
+        generator.close()
+        self.assertEqual("cancelled", self.events[-1]["status"])
+        self.assertEqual([self.events.append], metrics.hooks)
+
+    def test_jsonlines_hook(self):
+        output = StringIO.StringIO()
+        metrics.add_hook(metrics.JSONLinesHook(output))
+        metrics.emit("page", page=1)
+        self.assertEqual(1, json.loads(output.getvalue())["page"])
+
+    def test_prometheus_hook(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            metrics.add_hook(metrics.PrometheusHook(path))
+            with metrics.book("book1"):
+                with metrics.timed("cover") as record:
+                    record["bytes"] = 5
+            lines = open(path).read().splitlines()
+            self.assertEqual(0644, os.stat(path).st_mode & 0777)
+        finally:
+            os.remove(path)
+        self.assertTrue('pysheng_phase_bytes_total{phase="cover"} 5' in lines)
+        self.assertTrue('pysheng_books_total 1' in lines)
+
+    def test_throughput(self):
+        throughput = metrics.Throughput(window=10.0)
+        throughput.start_time -= 20.0
+        metrics.add_hook(throughput)
+        with metrics.timed("image") as record:
+            record["bytes"] = 1000
+        with metrics.timed("write") as record:
+            record["bytes"] = 1000
+        metrics.emit("page", page=1, bytes=1000)
+        self.assertEqual((100.0, 6.0), throughput.get_rates())
+        self.assertEqual((0.0, 0.0),
+                         throughput.get_rates(now=time.time() + 11.0))
+
+    def test_throughput_drops_old_samples(self):
+        throughput = metrics.Throughput(window=10.0)
+        for seconds in range(100):
+            throughput(dict(event="page", time=1000.0 + seconds, page=1))
+        self.assertEqual(11, len(throughput.samples))
+
+    def test_throughput_of_a_book(self):
+        throughput = metrics.Throughput(window=10.0, book_id="book1")
+        throughput.start_time -= 20.0
+        metrics.add_hook(throughput)
+        for book_id in ["book1", "book2"]:
+            with metrics.timed("image", book_id=book_id) as record:
+                record["bytes"] = 1000
+            metrics.emit("page", book_id=book_id, page=1, bytes=1000)
+        self.assertEqual((100.0, 6.0), throughput.get_rates())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import tempfile
+import StringIO
+import pstats
+import shutil
+import sys
+import os
+
+import pysheng
+from pysheng import metrics, profiling
+import mockserver
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "pysheng.prof")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_profile(self):
+        stream = StringIO.StringIO()
+        with profiling.profile(self.path, memory=True, stream=stream):
+            with metrics.timed("image", "http://server/image") as record:
+                record["bytes"] = 1000
+        report = stream.getvalue()
+        self.assertTrue(pstats.Stats(self.path))
+        self.assertTrue("image fetch" in report)
+        self.assertTrue("Wall-clock time" in report)
+        self.assertTrue("Peak RSS" in report)
+        self.assertEqual([], metrics.hooks)
+
+    def test_profile_command_line(self):
+        download = sys.modules["pysheng.download"]
+        books_url = download.BOOKS_URL
+        server = mockserver.MockServer(mockserver.Config(npages=2)).start()
+        download.BOOKS_URL = server.url + "/books"
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            download.main(["-q", "--profile", self.path, "-o",
+                           os.path.join(self.directory, "book"), "mockbook"])
+            report = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            download.BOOKS_URL = books_url
+            server.stop()
+        lines = dict((line[:12].strip(), line.split()[-5:])
+                     for line in report.splitlines())
+        # requests, errors, bytes and seconds of each phase
+        self.assertEqual("1", lines["info fetch"][0])
+        self.assertEqual("2", lines["image fetch"][0])
+        self.assertEqual("2", lines["write"][0])
+        self.assertTrue(os.path.isfile(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import tempfile
+import shutil
+import sys
+import os
+
+import pysheng
+from pysheng import lib, sessions
+import mockserver
+
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "cookies.txt")
+        self.download = sys.modules["pysheng.download"]
+        self.books_url = self.download.BOOKS_URL
+        self.server = mockserver.MockServer(mockserver.Config(npages=2))
+        self.server.start()
+        self.download.BOOKS_URL = self.server.url + "/books"
+
+    def tearDown(self):
+        self.download.BOOKS_URL = self.books_url
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def get_cookies(self, store):
+        return dict((cookie.name, cookie.value) for cookie in store.load())
+
+    def test_session_is_reused_between_runs(self):
+        store = sessions.SessionStore(self.path)
+        opener = store.get_opener()
+        pysheng.get_info_from_url("mockbook", opener=opener)
+        store.save(opener)
+        opener2 = sessions.SessionStore(self.path).get_opener()
+        list(pysheng.download_book("mockbook", opener=opener2))
+        self.assertEqual(["session1"], self.server.sessions)
+
+    def test_save_keeps_cookies_from_other_processes(self):
+        store1 = sessions.SessionStore(self.path)
+        store2 = sessions.SessionStore(self.path)
+        opener1 = store1.get_opener()
+        opener2 = store2.get_opener()
+        pysheng.get_info_from_url("mockbook", opener=opener1)
+        store1.save(opener1)
+        self.assertEqual({"NID": "session1"}, self.get_cookies(store2))
+        store2.save(opener2)
+        self.assertEqual({"NID": "session1"}, self.get_cookies(store1))
+
+    def test_corrupted_file_is_a_cold_session(self):
+        open(self.path, "w").write("garbage")
+        store = sessions.SessionStore(self.path)
+        self.assertEqual({}, self.get_cookies(store))
+
+    def test_get_cookies_opener_loads_file(self):
+        store = sessions.SessionStore(self.path)
+        opener = store.get_opener()
+        pysheng.get_info_from_url("mockbook", opener=opener)
+        store.save(opener)
+        opener2 = lib.get_cookies_opener(self.path)
+        self.assertEqual(1, len(opener2.cookie_jar))
+
+
+class TestSessionPool(unittest.TestCase):
+    def setUp(self):
+        self.download = sys.modules["pysheng.download"]
+        self.books_url = self.download.BOOKS_URL
+        self.config = mockserver.Config(npages=6, session_quota=2)
+        self.server = mockserver.MockServer(self.config).start()
+        self.download.BOOKS_URL = self.server.url + "/books"
+
+    def tearDown(self):
+        self.download.BOOKS_URL = self.books_url
+        self.server.stop()
+
+    def test_rotation(self):
+        pool = sessions.SessionPool(openers=["a", "b", "c"])
+        self.assertEqual("a", pool.get())
+        self.assertEqual(["b", "c", "a"], list(pool.rotation()))
+        pool.retire("a")
+        self.assertEqual(["b", "c"], list(pool.rotation()))
+        self.assertEqual(["c", "b"], list(pool.rotation()))
+        pool.reset()
+        self.assertEqual(["b", "c", "a"], pool.active)
+
+    def test_restricted_pages_are_requeued_onto_other_sessions(self):
+        pool = sessions.SessionPool(3)
+        missing_pages = []
+        pages = [page for (info, page, data) in pysheng.download_book(
+                 "mockbook", pool=pool, missing_pages=missing_pages)]
+        self.assertEqual(range(6), pages)
+        self.assertEqual([], missing_pages)
+
+    def test_unobtainable_pages_are_reported(self):
+        pool = sessions.SessionPool(1)
+        missing_pages = []
+        pages = [page for (info, page, data) in pysheng.download_book(
+                 "mockbook", pool=pool, missing_pages=missing_pages,
+                 retries=0)]
+        self.assertEqual([0, 1], pages)
+        self.assertEqual([2, 3, 4, 5], missing_pages)
+        # The last session is never retired
+        self.assertEqual(1, len(pool.active))
+
+    def test_restricted_page_does_not_retire_the_last_session(self):
+        self.config.npages = 8
+        self.config.session_quota = None
+        self.config.restricted_pages = set(["PA2"])
+        pool = sessions.SessionPool(1)
+        missing_pages = []
+        pages = [page for (info, page, data) in pysheng.download_book(
+                 "mockbook", pool=pool, missing_pages=missing_pages,
+                 retries=0)]
+        self.assertEqual([0, 2, 3, 4, 5, 6, 7], pages)
+        self.assertEqual([1], missing_pages)
+        records = list(self.download.resolve_book("mockbook", pool=pool))
+        self.assertEqual([2], [record["page"] for record in records
+                               if record["restricted"]])
+
+    def test_restricted_page_is_page_specific(self):
+        self.config.session_quota = None
+        self.config.restricted_pages = set(["PA2"])
+        pool = sessions.SessionPool(2)
+        missing_pages = []
+        pages = [page for (info, page, data) in pysheng.download_book(
+                 "mockbook", pool=pool, missing_pages=missing_pages,
+                 retries=0)]
+        self.assertEqual([0, 2, 3, 4, 5], pages)
+        self.assertEqual([1], missing_pages)
+        self.assertEqual(2, len(pool.active))
+
+    def test_restricted_pages_are_retried_at_the_end(self):
+        pool = sessions.SessionPool(1)
+        missing_pages = []
+        pages = [page for (info, page, data) in pysheng.download_book(
+                 "mockbook", pool=pool, missing_pages=missing_pages,
+                 retries=1)]
+        self.assertEqual([0, 1, 2, 3], pages)
+        self.assertEqual([4, 5], missing_pages)
+        missing_pages = []
+        pages = [page for (info, page, data) in pysheng.download_book(
+                 "mockbook", missing_pages=missing_pages, retries=2)]
+        self.assertEqual(range(6), pages)
+        self.assertEqual([], missing_pages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from pysheng import store
+
+
+class TestImageStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = store.ImageStore(os.path.join(self.directory, "store"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_is_content_addressed(self):
+        digest1 = self.store.put("image data")
+        digest2 = self.store.put("image data")
+        self.assertEqual(digest1, digest2)
+        self.assertTrue(self.store.contains(digest1))
+        self.assertEqual("image data", self.store.read(digest1))
+
+    def test_keys(self):
+        self.assertEqual(None, self.store.get_key("book/PP1"))
+        digest = self.store.put("image data")
+        self.store.set_key(u"book/PP1", digest)
+        self.assertEqual(digest, self.store.get_key("book/PP1"))
+
+    def test_write_links_pages_to_the_same_object(self):
+        path1 = os.path.join(self.directory, "001.png")
+        path2 = os.path.join(self.directory, "002.png")
+        digest = self.store.write(path1, "blank page", key="book1/PP1")
+        self.store.write(path2, "blank page", key="book2/PP1")
+        self.assertEqual("blank page", open(path1).read())
+        self.assertEqual("blank page", open(path2).read())
+        self.assertEqual(digest, self.store.get_key("book2/PP1"))
+        if hasattr(os, "link"):
+            self.assertEqual(3, os.stat(self.store.get_path(digest)).st_nlink)
+
+
+class TestInfoCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = store.InfoCache(os.path.join(self.directory, "info"))
+        self.info = dict(title="A book", page_ids=["PP1", "PP2"])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_get(self):
+        self.assertEqual(None, self.cache.get("book1"))
+        self.cache.put("book1", self.info)
+        self.assertEqual(self.info, self.cache.get("book1"))
+        self.assertEqual(None, self.cache.get("book2"))
+
+    def test_old_entries_are_ignored(self):
+        self.cache.put("book1", self.info)
+        self.cache.max_age = 60
+        self.assertEqual(self.info, self.cache.get("book1"))
+        old_time = os.path.getmtime(self.cache.get_path("book1")) - 120
+        os.utime(self.cache.get_path("book1"), (old_time, old_time))
+        self.assertEqual(None, self.cache.get("book1"))
+
+    def test_corrupted_entry_is_a_miss(self):
+        open(self.cache.get_path("book1"), "w").write("{")
+        self.assertEqual(None, self.cache.get("book1"))
+
+
+class TestWriteAtomic(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "sub", "file")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_atomic(self):
+        data = "x" * (1024 * 1024)
+        store.write_atomic(self.path, data)
+        self.assertEqual(data, open(self.path, "rb").read())
+        self.assertEqual(["file"], os.listdir(os.path.dirname(self.path)))
+
+    def test_failed_write_leaves_no_files(self):
+        self.assertRaises(TypeError, store.write_atomic, self.path, None)
+        self.assertEqual([], os.listdir(os.path.dirname(self.path)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import threading
+import time
+
+from pysheng import throttle, lib
+import mockserver
+
+
+class TestThrottle(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = throttle.TokenBucket(rate=10000, burst=1000)
+        itime = time.time()
+        bucket.consume(1000)
+        self.assertTrue(time.time() - itime < 0.05)
+        bucket.consume(2000)
+        self.assertTrue(time.time() - itime >= 0.19)
+
+    def test_token_bucket_without_rate(self):
+        bucket = throttle.TokenBucket()
+        itime = time.time()
+        bucket.consume(10 ** 9)
+        self.assertTrue(time.time() - itime < 0.05)
+
+    def test_host_limiter(self):
+        limiter = throttle.HostLimiter(limit=2)
+        current = dict(host0=0, host1=0)
+        peak = dict(host0=0, host1=0)
+        lock = threading.Lock()
+
+        def connect(host):
+            with limiter.connection("http://%s/page" % host):
+                with lock:
+                    current[host] += 1
+                    peak[host] = max(peak[host], current[host])
+                time.sleep(0.02)
+                with lock:
+                    current[host] -= 1
+        threads = [threading.Thread(target=connect, args=("host%d" % (i % 2),))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(peak["host0"] <= 2)
+        self.assertTrue(peak["host1"] <= 2)
+
+    def test_get_host(self):
+        self.assertEqual("books.google.com:8080", throttle.get_host(
+            "http://Books.Google.com:8080/books?id=1"))
+        self.assertEqual("books.google.com", throttle.get_host(
+            lib.build_request("http://books.google.com")))
+
+    def test_parse_rate(self):
+        self.assertEqual(500, throttle.parse_rate("500"))
+        self.assertEqual(200 * 1024, throttle.parse_rate("200k"))
+        self.assertEqual(1536 * 1024, throttle.parse_rate("1.5M"))
+        self.assertRaises(ValueError, throttle.parse_rate, "fast")
+
+
+class TestThrottledDownload(unittest.TestCase):
+    def setUp(self):
+        config = mockserver.Config(image_size=20000)
+        self.server = mockserver.MockServer(config).start()
+
+    def tearDown(self):
+        throttle.configure()
+        self.server.stop()
+
+    def test_download_is_limited(self):
+        url = self.server.url + "/books?id=book&pg=PA1&img=1&sig=MOCK"
+        throttle.configure(rate=20000, per_host=1)
+        throttle.bandwidth.tokens = 0
+        itime = time.time()
+        data = lib.download(url)
+        self.assertEqual(20000, len(data))
+        self.assertTrue(time.time() - itime >= 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+# Copyright (c) Arnau Sanchez <tokland@gmail.com>
+
+# This script is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>
+
+import unittest
+import threading
+import Queue
+
+from pysheng import thumbnails
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        evicted = []
+        cache = thumbnails.LRUCache(2, lambda key, value:
+                                    evicted.append((key, value)))
+        cache.put(1, "a")
+        cache.put(2, "b")
+        self.assertEqual("a", cache.get(1))
+        cache.put(3, "c")
+        self.assertEqual([(2, "b")], evicted)
+        self.assertEqual(2, len(cache))
+        self.assertTrue(1 in cache and 3 in cache)
+        self.assertEqual(None, cache.get(2))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual([(2, "b")], evicted)
+
+
+class TestThumbnailLoader(unittest.TestCase):
+    def setUp(self):
+        self.results = Queue.Queue()
+        self.started = threading.Event()
+        self.blocked = threading.Event()
+
+    def decode(self, key):
+        if key == "block":
+            self.started.set()
+            self.blocked.wait()
+        elif key == "bad":
+            raise IOError("Cannot decode")
+        return key.upper()
+
+    def get_results(self, n):
+        return [self.results.get(timeout=5) for _ in range(n)]
+
+    def test_decode_requested_keys(self):
+        loader = thumbnails.ThumbnailLoader(
+            self.decode, lambda key, value: self.results.put((key, value)))
+        loader.request(["a", "bad", "b"])
+        self.assertEqual([("a", "A"), ("bad", None), ("b", "B")],
+                         self.get_results(3))
+        loader.stop()
+
+    def test_request_replaces_pending_keys(self):
+        loader = thumbnails.ThumbnailLoader(
+            self.decode, lambda key, value: self.results.put((key, value)))
+        loader.request(["block", "a", "b"])
+        self.started.wait(5)
+        loader.request(["c"])
+        self.blocked.set()
+        self.assertEqual([("block", "BLOCK"), ("c", "C")],
+                         self.get_results(2))
+        loader.stop()
+        loader.thread.join(5)
+        self.assertFalse(loader.thread.isAlive())
+        self.assertTrue(self.results.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()